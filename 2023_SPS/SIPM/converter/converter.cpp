@@ -1,46 +1,163 @@
 #include "converter.h"
 
 Verbose VERBOSE = Verbose::kQuiet;
+// Threads decoding the events (and compressing the ROOT baskets)
+unsigned N_THREADS = std::max(1u, std::thread::hardware_concurrency());
+// Also write the complete triggers (SiPMEvents tree)
+bool ALIGNED = false;
+// Skip corrupted regions of the file instead of stopping
+bool RECOVER = false;
+
+bool isCompressed(const std::string& fileName) {
+  const std::string extension = fileName.substr(fileName.find_last_of(".") + 1);
+  return extension == "bz2" || extension == "zst";
+}
 
-uint32_t getFileSize(const std::string& fileName) {
-  std::ifstream inputStream(fileName, std::ios::binary | std::ios::ate);
-  logging("Opening file: " + fileName, Verbose::kInfo);
+// Run.dat.bz2 -> Run.dat, so that the ROOT file is named after the raw data
+std::string rawFileName(const std::string& fileName) {
+  if (isCompressed(fileName)) {
+    return fileName.substr(0, fileName.find_last_of("."));
+  }
+  return fileName;
+}
 
-  if (!inputStream) {
-    logging("Cannot open file: " + fileName, Verbose::kError);
-    exit(EXIT_FAILURE);
+// Writes n bytes to the file descriptor fd (decompressed raw data)
+void writeAll(const int fd, const char* bytes, size_t n) {
+  while (n > 0) {
+    const ssize_t written = write(fd, bytes, n);
+    if (written < 0) {
+      logging("Cannot write decompressed data!", Verbose::kError);
+      exit(EXIT_FAILURE);
+    }
+    bytes += written;
+    n -= written;
   }
+}
 
-  const uint32_t fileSize = static_cast<uint32_t>(inputStream.tellg());
+// Decompresses a bzip2 stream into fd, 1 MB at a time; returns the decompressed size
+uint64_t decompressBz2(std::ifstream& inputStream, const int fd) {
+  std::vector<char> in(1 << 20), out(1 << 20);
+  uint64_t size = 0;
+  bz_stream stream{};
+  BZ2_bzDecompressInit(&stream, 0, 0);
+  bool inputDone = false;
+  int status = BZ_OK;
+  while (true) {
+    if (stream.avail_in == 0 && !inputDone) {
+      inputStream.read(in.data(), in.size());
+      stream.next_in = in.data();
+      stream.avail_in = inputStream.gcount();
+      inputDone = stream.avail_in == 0;
+    }
+    stream.next_out = out.data();
+    stream.avail_out = out.size();
+    status = BZ2_bzDecompress(&stream);
+    if (status != BZ_OK && status != BZ_STREAM_END) {
+      logging("Corrupted bzip2 data, error " + std::to_string(status), Verbose::kError);
+      exit(EXIT_FAILURE);
+    }
+    writeAll(fd, out.data(), stream.next_out - out.data());
+    size += stream.next_out - out.data();
+    if (status == BZ_STREAM_END) {
+      if (stream.avail_in == 0 && inputStream.peek() == EOF) {
+        break;
+      }
+      // lbzip2 and pbzip2 write many streams: go on with the next one
+      char* next = stream.next_in;
+      const unsigned int avail = stream.avail_in;
+      BZ2_bzDecompressEnd(&stream);
+      stream = bz_stream{};
+      BZ2_bzDecompressInit(&stream, 0, 0);
+      stream.next_in = next;
+      stream.avail_in = avail;
+    } else if (inputDone && stream.next_out == out.data()) {
+      logging("Truncated bzip2 file!", Verbose::kError);
+      exit(EXIT_FAILURE);
+    }
+  }
+  BZ2_bzDecompressEnd(&stream);
+  return size;
+}
 
-  inputStream.close();
-  if (inputStream.is_open()) {
-    logging("Cannot close file file: " + fileName, Verbose::kError);
+// Decompresses a zstd stream into fd, one block at a time; returns the decompressed size
+uint64_t decompressZstd(std::ifstream& inputStream, const int fd) {
+  std::vector<char> in(ZSTD_DStreamInSize()), out(ZSTD_DStreamOutSize());
+  uint64_t size = 0;
+  ZSTD_DCtx* context = ZSTD_createDCtx();
+  size_t status = 0;
+  while (inputStream.read(in.data(), in.size()) || inputStream.gcount() > 0) {
+    ZSTD_inBuffer input = {in.data(), static_cast<size_t>(inputStream.gcount()), 0};
+    while (input.pos < input.size) {
+      ZSTD_outBuffer output = {out.data(), out.size(), 0};
+      status = ZSTD_decompressStream(context, &output, &input);
+      if (ZSTD_isError(status)) {
+        logging("Corrupted zstd data: " + std::string(ZSTD_getErrorName(status)), Verbose::kError);
+        exit(EXIT_FAILURE);
+      }
+      writeAll(fd, out.data(), output.pos);
+      size += output.pos;
+    }
+  }
+  ZSTD_freeDCtx(context);
+  // Non zero: the last frame is not complete
+  if (status != 0) {
+    logging("Truncated zstd file!", Verbose::kError);
     exit(EXIT_FAILURE);
   }
-  logging("File size: " + std::to_string(fileSize / (1024 * 1024)) + " Mb", Verbose::kInfo);
-  return fileSize;
+  return size;
 }
 
-std::vector<char> readRawData(const std::string& fileName, const uint32_t size) {
-  std::vector<char> data(size);
-  std::ifstream inputStream(fileName, std::ios::binary | std::ios::in);
-  if (!inputStream) {
-    logging("Cannot open file: " + fileName, Verbose::kError);
+RawData::RawData(const std::string& fileName) {
+  logging("Opening file: " + fileName, Verbose::kInfo);
+  int fd;
+  if (isCompressed(fileName)) {
+    std::ifstream inputStream(fileName, std::ios::binary | std::ios::in);
+    if (!inputStream) {
+      logging("Cannot open file: " + fileName, Verbose::kError);
+      exit(EXIT_FAILURE);
+    }
+    // The whole run is decompressed (streamed, a block at a time) into a temporary file next to the
+    // archive, deleted as soon as it is created: it is then mapped as a .dat, so the decompressed data
+    // are on disk and in the page cache, not in memory, and the file is gone when the converter exits
+    std::string temporary = rawFileName(fileName) + ".XXXXXX";
+    fd = mkstemp(&temporary[0]);
+    if (fd < 0) {
+      logging("Cannot create temporary file: " + temporary, Verbose::kError);
+      exit(EXIT_FAILURE);
+    }
+    unlink(temporary.c_str());
+    logging("Decompressing raw data...", Verbose::kInfo);
+    size = fileName.substr(fileName.find_last_of(".") + 1) == "bz2" ? decompressBz2(inputStream, fd)
+                                                                    : decompressZstd(inputStream, fd);
+  } else {
+    fd = open(fileName.c_str(), O_RDONLY);
+    struct stat fileStat;
+    if (fd < 0 || fstat(fd, &fileStat) != 0) {
+      logging("Cannot open file: " + fileName, Verbose::kError);
+      exit(EXIT_FAILURE);
+    }
+    size = fileStat.st_size;
+  }
+  if (size < FILE_HEADER_SIZE) {
+    logging("File too short: " + fileName, Verbose::kError);
     exit(EXIT_FAILURE);
   }
-  logging("Reading raw data...", Verbose::kInfo);
-
-  inputStream.read(data.data(), size);
-  inputStream.close();
-  if (inputStream.is_open()) {
-    logging("Cannot close file file: " + fileName, Verbose::kError);
+  void* map = mmap(nullptr, size, PROT_READ, MAP_PRIVATE, fd, 0);
+  // The mapping stays valid after closing the file (and keeps the deleted temporary file)
+  close(fd);
+  if (map == MAP_FAILED) {
+    logging("Cannot map file: " + fileName, Verbose::kError);
     exit(EXIT_FAILURE);
   }
-  return data;
+  // Events are read in order: read ahead
+  madvise(map, size, MADV_SEQUENTIAL);
+  data = static_cast<const char*>(map);
+  logging("File size: " + std::to_string(size / (1024 * 1024)) + " Mb", Verbose::kInfo);
 }
 
-FileHeader getFileHeader(const std::vector<char>& rawData) {
+RawData::~RawData() { munmap(const_cast<char*>(data), size); }
+
+FileHeader getFileHeader(const RawData& rawData) {
   FileHeader header;
   uint8_t dfv1, dfv2, swv1, swv2, swv3;
 
@@ -57,10 +174,74 @@ FileHeader getFileHeader(const std::vector<char>& rawData) {
   return header;
 }
 
-FileInfo getFileInfo(const std::vector<char>& rawData, const FileHeader& header) {
+// Event at iByte consistent with itself: board ID accepted as in normal mode (up to MAX_BOARD_ID), size given
+// by the channel mask, event inside the file
+// and channel ids that can be mapped (decoding garbage would write out of the arrays)
+bool validEvent(const RawData& rawData, const uint64_t iByte, const AcquisitionMode mode) {
+  if (iByte + EVENT_HEADER_SIZE[(int)mode] > rawData.size) {
+    return false;
+  }
+  uint16_t eventSize;
+  uint8_t boardId;
+  uint64_t channelMask;
+  std::memcpy(&eventSize, &rawData[iByte], sizeof(uint16_t));
+  std::memcpy(&boardId, &rawData[iByte + 2], sizeof(uint8_t));
+  std::memcpy(&channelMask, &rawData[iByte + 19], sizeof(uint64_t));
+  if (boardId > MAX_BOARD_ID || channelMask == 0 ||
+      eventSize != EVENT_HEADER_SIZE[(int)mode] + popcount(channelMask) * EVENTS_SIZE[(int)mode] ||
+      iByte + eventSize > rawData.size) {
+    return false;
+  }
+  for (uint64_t channel = iByte + EVENT_HEADER_SIZE[(int)mode]; channel < iByte + eventSize;
+       channel += EVENTS_SIZE[(int)mode]) {
+    if (static_cast<uint8_t>(rawData[channel]) >= NCHANNELS) {
+      return false;
+    }
+  }
+  return true;
+}
+
+// Start of the first plausible event from iByte on (file size if none).
+// Candidates are found with memchr on the first byte of the size of a full event (all channels),
+// so the scan runs at memory speed; they need to be a valid event, a trigger id close to the last good one
+// (if any) and to be followed by another valid event (or the end of the file)
+uint64_t findNextEvent(const RawData& rawData, uint64_t iByte, const AcquisitionMode mode,
+                       const uint64_t lastTriggerId, const bool checkTrigger) {
+  const uint16_t fullSize = EVENT_HEADER_SIZE[(int)mode] + NCHANNELS * EVENTS_SIZE[(int)mode];
+  const uint64_t start = iByte;
+  while (iByte + EVENT_HEADER_SIZE[(int)mode] <= rawData.size) {
+    const void* found = std::memchr(rawData.data + iByte, fullSize & 0xFF, rawData.size - iByte);
+    if (found == nullptr) {
+      break;
+    }
+    iByte = static_cast<const char*>(found) - rawData.data;
+    // No room left for an event header
+    if (iByte + EVENT_HEADER_SIZE[(int)mode] > rawData.size) {
+      break;
+    }
+    if (static_cast<uint8_t>(rawData[iByte + 1]) == (fullSize >> 8) && validEvent(rawData, iByte, mode)) {
+      uint16_t eventSize;
+      uint64_t triggerId;
+      std::memcpy(&eventSize, &rawData[iByte], sizeof(uint16_t));
+      std::memcpy(&triggerId, &rawData[iByte + 11], sizeof(uint64_t));
+      // Every lost event may have been a new trigger
+      const uint64_t maxJump = RESYNC_TRIGGER_WINDOW + (iByte - start) / EVENT_HEADER_SIZE[(int)mode];
+      const bool closeTrigger =
+          !checkTrigger || (triggerId + RESYNC_TRIGGER_WINDOW >= lastTriggerId && triggerId <= lastTriggerId + maxJump);
+      const bool followed = iByte + eventSize == rawData.size || validEvent(rawData, iByte + eventSize, mode);
+      if (closeTrigger && followed) {
+        return iByte;
+      }
+    }
+    iByte++;
+  }
+  return rawData.size;
+}
+
+FileInfo getFileInfo(const RawData& rawData, const FileHeader& header) {
   FileInfo fileInfo;
-  const uint64_t fileSize = rawData.size(); // Size in bytes of whole file
-  uint32_t iByte = FILE_HEADER_SIZE;        // Skip bytes (header)
+  const uint64_t fileSize = rawData.size;   // Size in bytes of whole file
+  uint64_t iByte = FILE_HEADER_SIZE;        // Skip bytes (header)
   uint32_t errors = 0;                      // Errors in file
 
   fileInfo.eventStartByte.reserve(1000000); // Reasonable number
@@ -91,11 +272,25 @@ FileInfo getFileInfo(const std::vector<char>& rawData, const FileHeader& header)
   }
 
   uint64_t iEvent = 0;
-  while (iByte < fileSize) {
+  uint64_t lastTriggerId = 0; // Trigger id of the last good event (recovery mode)
+  // Header of the event (27 bytes) still in the file
+  while (iByte + EVENT_HEADER_SIZE[(int)fileInfo.acquisitionMode] <= fileSize) {
     uint16_t eventSize;   // Current event size as per stored in file
     uint8_t boardId;      // Current board id
     uint64_t channelMask; // Byte mask of channels read out
 
+    if (RECOVER && !validEvent(rawData, iByte, fileInfo.acquisitionMode)) {
+      // Corrupted (or truncated) data: go on from the next plausible event
+      const uint64_t next =
+          findNextEvent(rawData, iByte + 1, fileInfo.acquisitionMode, lastTriggerId, fileInfo.nEvents > 0);
+      logging("Corrupted data, skipped bytes " + std::to_string(iByte) + " - " + std::to_string(next),
+              Verbose::kWarn);
+      fileInfo.skippedBytes.emplace_back(iByte, next);
+      errors++;
+      iByte = next;
+      continue;
+    }
+
     // Get data from binary data
     std::memcpy(&eventSize, &rawData[iByte], sizeof(uint16_t));
     std::memcpy(&boardId, &rawData[iByte + 2], sizeof(uint8_t));
@@ -114,13 +309,20 @@ FileInfo getFileInfo(const std::vector<char>& rawData, const FileHeader& header)
       logging("= Something went very wrong! Event size is 0! =", Verbose::kError);
       logging("===============================================", Verbose::kError);
       exit(EXIT_FAILURE);
-    } else if (boardId > 15) {
+    } else if (boardId > MAX_BOARD_ID) {
       logging("================================================", Verbose::kError);
       logging("= Something went very wrong! Board ID is > 15! =", Verbose::kError);
       logging("================================================", Verbose::kError);
       exit(EXIT_FAILURE);
     }
 
+    if (iByte + eventSize > fileSize) {
+      // Acquisition stopped while writing: reading past the mapping would crash
+      logging("Last event truncated, skipped", Verbose::kWarn);
+      errors++;
+      break;
+    }
+
     if (eventSize != expectedEventSize) {
       logging("Caught error in file!", Verbose::kWarn);
       logging("Event number:" + std::to_string(iEvent), Verbose::kWarn);
@@ -138,6 +340,7 @@ FileInfo getFileInfo(const std::vector<char>& rawData, const FileHeader& header)
       }
       // Increase event counts (count events without errors)
       fileInfo.nEvents++;
+      std::memcpy(&lastTriggerId, &rawData[iByte + 11], sizeof(uint64_t));
     }
     // Go to next event
     iByte += eventSize;
@@ -148,6 +351,15 @@ FileInfo getFileInfo(const std::vector<char>& rawData, const FileHeader& header)
   fileInfo.nBoards += 1;
 
   logging("Errors found in file: " + std::to_string(errors), Verbose::kInfo);
+  if (!fileInfo.skippedBytes.empty()) {
+    uint64_t skipped = 0;
+    for (const auto& range : fileInfo.skippedBytes) {
+      skipped += range.second - range.first;
+    }
+    logging("Recovered from " + std::to_string(fileInfo.skippedBytes.size()) + " corrupted regions, " +
+                std::to_string(skipped) + " bytes skipped",
+            Verbose::kError);
+  }
   logging("Number of boards detected: " + std::to_string(fileInfo.nBoards), Verbose::kInfo);
   logging("Total number of events to process: " + std::to_string(fileInfo.nEvents), Verbose::kInfo);
   for (int i = 0; i < fileInfo.nBoards; ++i) {
@@ -157,130 +369,292 @@ FileInfo getFileInfo(const std::vector<char>& rawData, const FileHeader& header)
   return fileInfo;
 }
 
-std::vector<Event> parseData(const std::vector<char>& rawData, const FileInfo& fileInfo) {
-  logging("Starting to parse file... ", Verbose::kInfo);
-  std::vector<Event> events;
+void writeDataToRoot(const RawData& rawData, const FileInfo& fileInfo, const std::string& fileName) {
   switch (fileInfo.acquisitionMode) {
   case AcquisitionMode::kSpectroscopy:
-    events = parseSpectroscopyData(rawData, fileInfo);
+    writeSpectroscopyToRoot(rawData, fileInfo, fileName);
     break;
   case AcquisitionMode::kSpectroscopyTiming:
-    events = parseSpectroscopyTimingData(rawData, fileInfo);
+    writeSpectroscopyTimingToRoot(rawData, fileInfo, fileName);
     break;
   }
-  return events;
 }
 
-void writeDataToRoot(const std::vector<Event>& eventsVector, const FileInfo& fileInfo, const std::string& fileName) {
-  switch (fileInfo.acquisitionMode) {
-  case AcquisitionMode::kSpectroscopy:
-    writeSpectroscopyToRoot(eventsVector, fileInfo, fileName);
-    break;
-  case AcquisitionMode::kSpectroscopyTiming:
-    writeSpectroscopyTimingToRoot(eventsVector, fileInfo, fileName);
-    break;
-  }
-}
+SpectroscopyEvent decodeSpectroscopyEvent(const RawData& rawData, const uint64_t startByte) {
+  SpectroscopyEvent event;
+
+  // Read and store event header data
+  std::memcpy(&event.boardId, &rawData[startByte + 2], sizeof(uint8_t));
+  std::memcpy(&event.triggerTimeStamp, &rawData[startByte + 3], sizeof(double));
+  std::memcpy(&event.triggerId, &rawData[startByte + 11], sizeof(uint64_t));
+
+  // 27 is event header size - 411 is event size
+  const uint64_t eventDataStartByte = startByte + 27;
+  // Loop on channels
+  // Assume to read always 64 channels
+  for (int j = 0; j < NCHANNELS; ++j) {
+    uint8_t channelId;
+    uint16_t lgPha, hgPha;
+    // Read event data
+    std::memcpy(&channelId, &rawData[eventDataStartByte + 6 * j], sizeof(uint8_t));
+    std::memcpy(&lgPha, &rawData[eventDataStartByte + 6 * j + 2], sizeof(uint16_t));
+    std::memcpy(&hgPha, &rawData[eventDataStartByte + 6 * j + 4], sizeof(uint16_t));
+    // Map channel to position in calorimeter
+    channelId = MAPPING_LUT[channelId];
+    // TODO: Understand why there are values > 4096 (Hardware/Firmware problem?)
+    if (lgPha > 4096) {
+      lgPha = 4096;
+    }
+    if (hgPha > 4096) {
+      hgPha = 4096;
+    }
+    // Store event data
+    event.lgPha[channelId] = lgPha;
+    event.hgPha[channelId] = hgPha;
+  } // Loop on channels
 
-std::vector<Event> parseSpectroscopyData(const std::vector<char>& rawData, const FileInfo& fileInfo) {
+  return event;
+}
 
-  // Retrieve number of events
-  const uint32_t nEvents = fileInfo.eventStartByte.size();
-  std::vector<Event> output(nEvents);
+SpectroscopyTimingEvent decodeSpectroscopyTimingEvent(const RawData& rawData, const uint64_t startByte) {
+  SpectroscopyTimingEvent event;
+
+  std::memcpy(&event.boardId, &rawData[startByte + 2], sizeof(uint8_t));
+  std::memcpy(&event.triggerTimeStamp, &rawData[startByte + 3], sizeof(double));
+  std::memcpy(&event.triggerId, &rawData[startByte + 11], sizeof(uint64_t));
+
+  // 27 is event header size - 795 is event size
+  const uint64_t eventDataStartByte = startByte + 27;
+  for (int j = 0; j < NCHANNELS; ++j) {
+    uint8_t channelId;
+    uint16_t lgPha, hgPha, tot;
+    uint32_t toa;
+    std::memcpy(&channelId, &rawData[eventDataStartByte + 12 * j], sizeof(uint8_t));
+    std::memcpy(&lgPha, &rawData[eventDataStartByte + 12 * j + 2], sizeof(uint16_t));
+    std::memcpy(&hgPha, &rawData[eventDataStartByte + 12 * j + 4], sizeof(uint16_t));
+    std::memcpy(&toa, &rawData[eventDataStartByte + 12 * j + 6], sizeof(uint32_t));
+    std::memcpy(&tot, &rawData[eventDataStartByte + 12 * j + 10], sizeof(uint16_t));
+    channelId = MAPPING_LUT[channelId]; // Map channel to position in calo
+    // TODO: Understand why there are values > 4096
+    if (lgPha > 4096) {
+      lgPha = 4096;
+    }
+    if (hgPha > 4096) {
+      hgPha = 4096;
+    }
+    event.lgPha[channelId] = lgPha;
+    event.hgPha[channelId] = hgPha;
+    event.toa[channelId] = toa;
+    event.tot[channelId] = tot;
+  }
+  return event;
+}
 
-  // Loop on events
-  for (uint32_t i = 0; i < nEvents; ++i) {
-    // Prepare single event
-    Event event;
-    // Starting byte of event
-    const uint32_t startByte = fileInfo.eventStartByte[i];
+WorkerPool::WorkerPool(const unsigned nWorkers) {
+  for (unsigned w = 0; w < nWorkers; ++w) {
+    workers.emplace_back(&WorkerPool::work, this, w);
+  }
+}
 
-    // Read and store event header data
-    std::memcpy(&event.boardId, &rawData[startByte + 2], sizeof(uint8_t));
-    std::memcpy(&event.triggerTimeStamp, &rawData[startByte + 3], sizeof(double));
-    std::memcpy(&event.triggerId, &rawData[startByte + 11], sizeof(uint64_t));
+WorkerPool::~WorkerPool() {
+  {
+    std::lock_guard<std::mutex> lock(mutex);
+    stop = true;
+  }
+  wake.notify_all();
+  for (auto& worker : workers) {
+    worker.join();
+  }
+}
 
-    // 27 is event header size - 411 is event size
-    const uint32_t eventDataStartByte = startByte + 27;
-    // Loop on channels
-    // Assume to read always 64 channels
-    for (int j = 0; j < NCHANNELS; ++j) {
-      uint8_t channelId;
-      uint16_t lgPha, hgPha;
-      // Read event data
-      std::memcpy(&channelId, &rawData[eventDataStartByte + 6 * j], sizeof(uint8_t));
-      std::memcpy(&lgPha, &rawData[eventDataStartByte + 6 * j + 2], sizeof(uint16_t));
-      std::memcpy(&hgPha, &rawData[eventDataStartByte + 6 * j + 4], sizeof(uint16_t));
-      // Map channel to position in calorimeter
-      channelId = MAPPING_LUT[channelId];
-      // TODO: Understand why there are values > 4096 (Hardware/Firmware problem?)
-      if (lgPha > 4096) {
-        lgPha = 4096;
-      }
-      if (hgPha > 4096) {
-        hgPha = 4096;
-      }
-      // Store event data
-      event.lgPha[channelId] = lgPha;
-      event.hgPha[channelId] = hgPha;
-    } // Loop on channels
-    // Store event
-    output[i] = event;
-  } // Loop on events
-
-  return output;
+// Hands job(begin, end) over [0, n) to the workers, after the previous job is done
+void WorkerPool::start(const uint64_t n, std::function<void(uint64_t, uint64_t)> newJob) {
+  wait();
+  {
+    std::lock_guard<std::mutex> lock(mutex);
+    job = std::move(newJob);
+    nItems = n;
+    pending = workers.size();
+    ++generation;
+  }
+  wake.notify_all();
 }
 
-std::vector<Event> parseSpectroscopyTimingData(const std::vector<char>& rawData, const FileInfo& fileInfo) {
-  std::vector<Event> output(fileInfo.nEvents);
+void WorkerPool::wait() {
+  std::unique_lock<std::mutex> lock(mutex);
+  done.wait(lock, [this] { return pending == 0; });
+}
 
-  for (uint32_t i = 0; i < fileInfo.nEvents; ++i) {
-    Event event;
-    const uint32_t startByte = fileInfo.eventStartByte[i];
+// Loop of worker w: runs its range of every new job
+void WorkerPool::work(const unsigned w) {
+  uint64_t jobsDone = 0;
+  std::unique_lock<std::mutex> lock(mutex);
+  while (true) {
+    wake.wait(lock, [&] { return stop || generation != jobsDone; });
+    if (stop) {
+      return;
+    }
+    jobsDone = generation;
+    const uint64_t perWorker = (nItems + workers.size() - 1) / workers.size();
+    const uint64_t begin = std::min<uint64_t>(w * perWorker, nItems);
+    const uint64_t end = std::min<uint64_t>(begin + perWorker, nItems);
+    lock.unlock();
+    if (begin < end) {
+      job(begin, end);
+    }
+    lock.lock();
+    if (--pending == 0) {
+      done.notify_all();
+    }
+  }
+}
 
-    uint8_t boardId;
-    double triggerTime;
-    uint64_t triggerId;
+// N_THREADS workers, created at the first decoding (after the options are read)
+WorkerPool& decodingWorkers() {
+  static WorkerPool workers(N_THREADS);
+  return workers;
+}
 
-    std::memcpy(&boardId, &rawData[startByte + 2], sizeof(uint8_t));
-    std::memcpy(&triggerTime, &rawData[startByte + 3], sizeof(double));
-    std::memcpy(&triggerId, &rawData[startByte + 11], sizeof(uint64_t));
+// Starts decoding the events first, first + 1, ... of the file into events on the decoding workers;
+// decodingWorkers().wait() returns when they are all decoded
+template <typename EventType, typename Decode>
+void startDecoding(const RawData& rawData, const FileInfo& fileInfo, Decode decode, const uint64_t first,
+                   std::vector<EventType>& events) {
+  decodingWorkers().start(events.size(), [&rawData, &fileInfo, decode, first, &events](uint64_t begin, uint64_t end) {
+    for (uint64_t i = begin; i < end; ++i) {
+      events[i] = decode(rawData, fileInfo.eventStartByte[first + i]);
+    }
+  });
+}
 
-    event.boardId = boardId;
-    event.triggerTimeStamp = triggerTime;
-    event.triggerId = triggerId;
+// Calls write(event) for all the events of the file in file order. Each block of DECODE_BLOCK_EVENTS
+// events is decoded in parallel while the previous one is being written
+template <typename EventType, typename Decode, typename Write>
+void forEachEvent(const RawData& rawData, const FileInfo& fileInfo, Decode decode, Write write) {
+  const uint64_t nEvents = fileInfo.eventStartByte.size();
+  std::vector<EventType> block, next(std::min(DECODE_BLOCK_EVENTS, nEvents));
+  startDecoding(rawData, fileInfo, decode, 0, next);
+  for (uint64_t first = 0; first < nEvents; first += DECODE_BLOCK_EVENTS) {
+    decodingWorkers().wait();
+    std::swap(block, next);
+    if (first + DECODE_BLOCK_EVENTS < nEvents) {
+      next.resize(std::min(DECODE_BLOCK_EVENTS, nEvents - first - DECODE_BLOCK_EVENTS));
+      startDecoding(rawData, fileInfo, decode, first + DECODE_BLOCK_EVENTS, next);
+    }
+    for (const auto& event : block) {
+      write(event);
+    }
+  }
+}
 
-    // 27 is event header size - 795 is event size
-    const uint32_t eventDataStartByte = startByte + 27;
-    for (int j = 0; j < NCHANNELS; ++j) {
-      uint8_t channelId;
-      uint16_t lgPha, hgPha, tot;
-      uint32_t toa;
-      std::memcpy(&channelId, &rawData[eventDataStartByte + 12 * j], sizeof(uint8_t));
-      std::memcpy(&lgPha, &rawData[eventDataStartByte + 12 * j + 2], sizeof(uint16_t));
-      std::memcpy(&hgPha, &rawData[eventDataStartByte + 12 * j + 4], sizeof(uint16_t));
-      std::memcpy(&toa, &rawData[eventDataStartByte + 12 * j + 6], sizeof(uint32_t));
-      std::memcpy(&tot, &rawData[eventDataStartByte + 12 * j + 10], sizeof(uint16_t));
-      channelId = MAPPING_LUT[channelId]; // Map channel to position in calo
-      // TODO: Understand why there are values > 4096
-      if (lgPha > 4096) {
-        lgPha = 4096;
+// Calls write(event) for all the events of the file ordered by trigger id (same trigger id: file order).
+// Events are decoded and sorted in runs of SORT_RUN_EVENTS; when there is more than one run, the runs
+// are spilled to temporary files and merged while writing, so memory does not grow with the file size
+template <typename EventType, typename Decode, typename Write>
+void forEachSortedEvent(const RawData& rawData, const FileInfo& fileInfo, Decode decode, Write write) {
+  const uint64_t nEvents = fileInfo.eventStartByte.size();
+  std::vector<EventType> run;
+  run.reserve(std::min<uint64_t>(nEvents, SORT_RUN_EVENTS));
+  std::vector<FILE*> spilled;
+
+  for (uint64_t first = 0; first < nEvents; first += SORT_RUN_EVENTS) {
+    run.resize(std::min(SORT_RUN_EVENTS, nEvents - first));
+    startDecoding(rawData, fileInfo, decode, first, run);
+    decodingWorkers().wait();
+    std::stable_sort(run.begin(), run.end());
+    if (spilled.empty() && first + run.size() == nEvents) {
+      // Single run: no need to go through disk
+      for (const auto& event : run) {
+        write(event);
       }
-      if (hgPha > 4096) {
-        hgPha = 4096;
-      }
-      event.lgPha[channelId] = lgPha;
-      event.hgPha[channelId] = hgPha;
-      event.toa[channelId] = toa;
-      event.tot[channelId] = tot;
+      return;
     }
-    output[i] = event;
+    FILE* file = std::tmpfile();
+    if (file == nullptr || fwrite(run.data(), sizeof(EventType), run.size(), file) != run.size()) {
+      logging("Cannot write temporary file to sort events!", Verbose::kError);
+      exit(EXIT_FAILURE);
+    }
+    std::rewind(file);
+    spilled.push_back(file);
+  }
+
+  // k-way merge, reading SORT_READ_EVENTS events of each run at a time
+  logging("Merging " + std::to_string(spilled.size()) + " sorted runs...", Verbose::kInfo);
+  std::vector<std::vector<EventType>> blocks(spilled.size());
+  std::vector<size_t> next(spilled.size(), 0);
+  const auto refill = [&](const size_t r) {
+    blocks[r].resize(SORT_READ_EVENTS);
+    blocks[r].resize(fread(blocks[r].data(), sizeof(EventType), SORT_READ_EVENTS, spilled[r]));
+    next[r] = 0;
+    return !blocks[r].empty();
+  };
+  // Smallest (trigger id, run) first: runs are in file order, so equal trigger ids keep it
+  using Head = std::pair<uint64_t, size_t>;
+  std::priority_queue<Head, std::vector<Head>, std::greater<Head>> heads;
+  for (size_t r = 0; r < spilled.size(); ++r) {
+    if (refill(r)) {
+      heads.emplace(blocks[r][0].triggerId, r);
+    }
+  }
+  while (!heads.empty()) {
+    const size_t r = heads.top().second;
+    heads.pop();
+    write(blocks[r][next[r]]);
+    if (++next[r] < blocks[r].size() || refill(r)) {
+      heads.emplace(blocks[r][next[r]].triggerId, r);
+    } else {
+      fclose(spilled[r]);
+    }
+  }
+}
+
+// Board-aligned output: one SiPMEvents entry per trigger with the fragments of all the boards, HG/LG as
+// [board][channel] in calorimeter mapping, i.e. the (20, 16) SiPM matrix. Boards not in the trigger are
+// zeros. As in align.py, only the first MAX_BOARDS fragments of a trigger are used, and if a board
+// appears twice its last fragment is kept
+AlignedWriter::AlignedWriter() : tree("SiPMEvents", "Complete triggers from SiPM") {
+  tree.Branch("HighGainADC", HighGainADC, "HighGainADC[320]/s", 128000);
+  tree.Branch("LowGainADC", LowGainADC, "LowGainADC[320]/s", 128000);
+  tree.Branch("TriggerId", &triggerId, "Triggerid/l", 128000);
+  tree.Branch("TriggerTimeStampUs", &triggerTime, "TriggerTimeStampUs/D", 128000);
+  tree.Branch("BoardMask", &boardMask, "BoardMask/b", 128000);
+}
+
+// Adds the next event (in order of trigger id): the trigger before is written when a new one starts
+template <typename EventType> void AlignedWriter::add(const EventType& event) {
+  if (nFragments > 0 && event.triggerId != triggerId) {
+    fill();
+  }
+  if (nFragments == 0) {
+    // Time stamp of the first fragment
+    triggerId = event.triggerId;
+    triggerTime = event.triggerTimeStamp;
+  }
+  if (nFragments++ < MAX_BOARDS && event.boardId < MAX_BOARDS) {
+    boardMask |= 1 << event.boardId;
+    std::memcpy(&HighGainADC[event.boardId * NCHANNELS], event.hgPha.begin(), NCHANNELS * sizeof(uint16_t));
+    std::memcpy(&LowGainADC[event.boardId * NCHANNELS], event.lgPha.begin(), NCHANNELS * sizeof(uint16_t));
+  }
+}
+
+void AlignedWriter::fill() {
+  tree.Fill();
+  std::memset(HighGainADC, 0, sizeof(HighGainADC));
+  std::memset(LowGainADC, 0, sizeof(LowGainADC));
+  boardMask = 0;
+  nFragments = 0;
+}
+
+// Writes the last trigger and the tree
+void AlignedWriter::finish() {
+  if (nFragments > 0) {
+    fill();
   }
-  std::sort(output.begin(), output.end());
-  return output;
+  tree.AutoSave();
+  logging("Complete triggers: " + std::to_string(tree.GetEntries()), Verbose::kInfo);
 }
 
-void writeSpectroscopyToRoot(const std::vector<Event>& events, const FileInfo& fileInfo, const std::string& fileName) {
+void writeSpectroscopyToRoot(const RawData& rawData, const FileInfo& fileInfo, const std::string& fileName) {
 
   // Change extension to file name
   const std::string rootFileName = fileName.substr(0, fileName.find_last_of(".")) + ".root";
@@ -321,27 +695,10 @@ void writeSpectroscopyToRoot(const std::vector<Event>& events, const FileInfo& f
   rootTreeEvent.Branch("TriggerTimeStampUs", &triggerTime, "TriggerTimeStampUs/D", 128000);
   rootTreeEvent.Branch("BoardId", &boardId, "BoardId/b", 128000);
 
-  logging("Starting to write per channel data...", Verbose::kPedantic);
-  for (const auto& event : events) {
-    boardId = event.boardId;
-    triggerId = event.triggerId;
-    triggerTime = event.triggerTimeStamp;
-    std::memcpy(HighGainADC, event.hgPha.begin(), NCHANNELS * sizeof(uint16_t));
-    std::memcpy(LowGainADC, event.lgPha.begin(), NCHANNELS * sizeof(uint16_t));
-    rootTreeEvent.Fill();
-  }
-  rootTreeEvent.AutoSave();
-  logging("Finished to write data...", Verbose::kPedantic);
-
-  // Create histograms for fast debugging
-  rootFile.mkdir("Histograms");
-  rootFile.cd("Histograms");
-
-  // Per channel histograms
+  // Per channel histograms, filled while writing the tree
   std::vector<std::vector<TH1I>> histoshg(fileInfo.nBoards, std::vector<TH1I>(NCHANNELS));
   std::vector<std::vector<TH1I>> histoslg(fileInfo.nBoards, std::vector<TH1I>(NCHANNELS));
 
-  logging("Starting to write per channel histograms...", Verbose::kPedantic);
   for (uint32_t i = 0; i < fileInfo.nBoards; ++i) {
     for (uint32_t j = 0; j < NCHANNELS; ++j) {
       const std::string titleHG = "HighGainADC Board " + std::to_string(i) + "Channel " + std::to_string(j);
@@ -351,16 +708,38 @@ void writeSpectroscopyToRoot(const std::vector<Event>& events, const FileInfo& f
     }
   }
 
-  // Fill histograms
-  for (const auto& event : events) {
-    const uint8_t bid = event.boardId;
+  // Events are written in file order: tree and histograms filled in one pass
+  logging("Starting to write per channel data...", Verbose::kPedantic);
+  forEachEvent<SpectroscopyEvent>(rawData, fileInfo, decodeSpectroscopyEvent, [&](const SpectroscopyEvent& event) {
+    boardId = event.boardId;
+    triggerId = event.triggerId;
+    triggerTime = event.triggerTimeStamp;
+    std::memcpy(HighGainADC, event.hgPha.begin(), NCHANNELS * sizeof(uint16_t));
+    std::memcpy(LowGainADC, event.lgPha.begin(), NCHANNELS * sizeof(uint16_t));
+    rootTreeEvent.Fill();
     for (uint32_t j = 0; j < NCHANNELS; ++j) {
-      histoslg[bid][j].Fill(event.lgPha[j]);
-      histoshg[bid][j].Fill(event.hgPha[j]);
+      histoslg[boardId][j].Fill(event.lgPha[j]);
+      histoshg[boardId][j].Fill(event.hgPha[j]);
     }
+  });
+  rootTreeEvent.AutoSave();
+  logging("Finished to write data...", Verbose::kPedantic);
+
+  if (ALIGNED) {
+    // SiPMData is in file order: the triggers need a sorted pass of their own
+    logging("Starting to write complete triggers...", Verbose::kPedantic);
+    AlignedWriter aligned;
+    forEachSortedEvent<SpectroscopyEvent>(rawData, fileInfo, decodeSpectroscopyEvent,
+                                          [&](const SpectroscopyEvent& event) { aligned.add(event); });
+    aligned.finish();
   }
 
+  // Create histograms for fast debugging
+  rootFile.mkdir("Histograms");
+  rootFile.cd("Histograms");
+
   // Write histograms to file
+  logging("Starting to write per channel histograms...", Verbose::kPedantic);
   for (uint32_t i = 0; i < fileInfo.nBoards; ++i) {
     for (uint32_t j = 0; j < NCHANNELS; ++j) {
       histoslg[i][j].Write();
@@ -387,8 +766,7 @@ void writeSpectroscopyToRoot(const std::vector<Event>& events, const FileInfo& f
   }
 }
 
-void writeSpectroscopyTimingToRoot(const std::vector<Event>& events, const FileInfo& fileInfo,
-                                   const std::string& fname) {
+void writeSpectroscopyTimingToRoot(const RawData& rawData, const FileInfo& fileInfo, const std::string& fname) {
   const std::string rootfname = fname.substr(0, fname.find_last_of(".")) + ".root";
 
   TFile rootFile(rootfname.c_str(), "RECREATE");
@@ -421,21 +799,6 @@ void writeSpectroscopyTimingToRoot(const std::vector<Event>& events, const FileI
   rootTreeEvent.Branch("TriggerTimeStampUs", &triggerTime, "TriggerTimeStampUs/D", 128000);
   rootTreeEvent.Branch("BoardId", &boardId, "BoardId/b", 128000);
 
-  for (const auto& event : events) {
-    boardId = event.boardId;
-    triggerId = event.triggerId;
-    triggerTime = event.triggerTimeStamp;
-    std::memcpy(HighGainADC, event.hgPha.begin(), NCHANNELS * sizeof(uint16_t));
-    std::memcpy(LowGainADC, event.lgPha.begin(), NCHANNELS * sizeof(uint16_t));
-    std::memcpy(Toa, event.toa.begin(), NCHANNELS * sizeof(uint32_t));
-    std::memcpy(Tot, event.tot.begin(), NCHANNELS * sizeof(uint16_t));
-    rootTreeEvent.Fill();
-  }
-  rootTreeEvent.AutoSave();
-
-  rootFile.mkdir("Histograms");
-  rootFile.cd("Histograms");
-
   std::vector<std::vector<TH1I>> histoslg(fileInfo.nBoards, std::vector<TH1I>(NCHANNELS));
   std::vector<std::vector<TH1I>> histoshg(fileInfo.nBoards, std::vector<TH1I>(NCHANNELS));
   std::vector<std::vector<TH1I>> histostot(fileInfo.nBoards, std::vector<TH1I>(NCHANNELS));
@@ -449,21 +812,46 @@ void writeSpectroscopyTimingToRoot(const std::vector<Event>& events, const FileI
       const std::string titleTOA = "ToaTDC Board " + std::to_string(i) + "Channel " + std::to_string(j);
       histoslg[i][j] = TH1I(titleLG.c_str(), "LowGainADC;ADC", 4096, 0, 4095);
       histoshg[i][j] = TH1I(titleHG.c_str(), "HighGainADC;ADC", 4096, 0, 4095);
-      histostot[i][j] = TH1I(titleHG.c_str(), "TotTDC;TDC", 4096, 0, 4095);
-      histostoa[i][j] = TH1I(titleHG.c_str(), "ToaTDC;TDC", 4096, 0, 4095);
+      histostot[i][j] = TH1I(titleTOT.c_str(), "TotTDC;TDC", 4096, 0, 4095);
+      histostoa[i][j] = TH1I(titleTOA.c_str(), "ToaTDC;TDC", 4096, 0, 4095);
     }
   }
 
-  for (const auto& event : events) {
-    uint8_t bid = event.boardId;
-    for (int j = 0; j < NCHANNELS; ++j) {
-      histoslg[bid][j].Fill(event.lgPha[j]);
-      histoshg[bid][j].Fill(event.hgPha[j]);
-      histostot[bid][j].Fill(event.tot[j]);
-      histostoa[bid][j].Fill(event.toa[j]);
-    }
+  // Complete triggers built in the same pass
+  std::unique_ptr<AlignedWriter> aligned;
+  if (ALIGNED) {
+    aligned = std::make_unique<AlignedWriter>();
+  }
+
+  // Tree and histograms filled in one pass, in order of trigger id
+  forEachSortedEvent<SpectroscopyTimingEvent>(
+      rawData, fileInfo, decodeSpectroscopyTimingEvent, [&](const SpectroscopyTimingEvent& event) {
+        boardId = event.boardId;
+        triggerId = event.triggerId;
+        triggerTime = event.triggerTimeStamp;
+        std::memcpy(HighGainADC, event.hgPha.begin(), NCHANNELS * sizeof(uint16_t));
+        std::memcpy(LowGainADC, event.lgPha.begin(), NCHANNELS * sizeof(uint16_t));
+        std::memcpy(Toa, event.toa.begin(), NCHANNELS * sizeof(uint32_t));
+        std::memcpy(Tot, event.tot.begin(), NCHANNELS * sizeof(uint16_t));
+        rootTreeEvent.Fill();
+        for (int j = 0; j < NCHANNELS; ++j) {
+          histoslg[boardId][j].Fill(event.lgPha[j]);
+          histoshg[boardId][j].Fill(event.hgPha[j]);
+          histostot[boardId][j].Fill(event.tot[j]);
+          histostoa[boardId][j].Fill(event.toa[j]);
+        }
+        if (aligned) {
+          aligned->add(event);
+        }
+      });
+  rootTreeEvent.AutoSave();
+  if (aligned) {
+    aligned->finish();
   }
 
+  rootFile.mkdir("Histograms");
+  rootFile.cd("Histograms");
+
   for (int i = 0; i < fileInfo.nBoards; ++i) {
     for (int j = 0; j < NCHANNELS; ++j) {
       histoslg[i][j].Write();
@@ -524,17 +912,35 @@ int main(int argc, char const* argv[]) {
         VERBOSE = Verbose::kPedantic;
       } else if (verboseLevel == "V") {
         VERBOSE = Verbose::kPedantic;
+      } else if (verboseLevel == "-a") {
+        ALIGNED = true;
+      } else if (verboseLevel == "-r") {
+        RECOVER = true;
+      } else if (verboseLevel.rfind("-j", 0) == 0) {
+        // Number of threads, as -j8
+        try {
+          N_THREADS = std::max(1, std::stoi(verboseLevel.substr(2)));
+        } catch (const std::exception&) {
+          logging("Invalid number of threads: " + verboseLevel, Verbose::kError);
+          printHelp();
+          exit(EXIT_FAILURE);
+        }
       } else {
         VERBOSE = Verbose::kQuiet;
       }
     }
   }
   const std::string fileName = argv[1];
+  const auto start = std::chrono::steady_clock::now();
 
-  const uint32_t fileSizeBytes = getFileSize(fileName);
+  // Baskets of the trees compressed in parallel
+  if (N_THREADS > 1) {
+    ROOT::EnableImplicitMT(N_THREADS);
+  }
+  logging("Threads: " + std::to_string(N_THREADS), Verbose::kInfo);
 
-  // Read all file
-  const std::vector<char> rawData = readRawData(fileName, fileSizeBytes);
+  // Map all file (.dat, or .dat.bz2/.dat.zst decompressed on the fly)
+  const RawData rawData(fileName);
 
   // Get file header (file size, starting time, ...)
   const FileHeader header = getFileHeader(rawData);
@@ -542,9 +948,10 @@ int main(int argc, char const* argv[]) {
   // Get file info (nBoards, nEvents, acqMode, ...)
   const FileInfo fileInfo = getFileInfo(rawData, header);
 
-  // Parse data
-  const std::vector<Event> events = parseData(rawData, fileInfo);
+  // Decode events and write them (streamed, sorted on disk if needed)
+  writeDataToRoot(rawData, fileInfo, rawFileName(fileName));
 
-  writeDataToRoot(events, fileInfo, fileName);
+  const std::chrono::duration<double> elapsed = std::chrono::steady_clock::now() - start;
+  logging("Converted in " + std::to_string(elapsed.count()) + " s", Verbose::kInfo);
   return 0;
 }
@@ -5,14 +5,28 @@
 #include "TTree.h"
 #include <algorithm>
 #include <array>
+#include <bzlib.h>
+#include <chrono>
+#include <condition_variable>
+#include <cstdio>
 #include <cstring>
 #include <fstream>
 #include <functional>
 #include <iostream>
+#include <memory>
+#include <mutex>
+#include <queue>
 #include <stdexcept>
 #include <stdlib.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
 #include <string>
+#include <thread>
+#include <utility>
 #include <vector>
+#include <zstd.h>
 
 #include "hardcoded.h"
 
@@ -26,16 +40,28 @@ struct FileHeader {
 
 // Contain info of events in file
 struct FileInfo {
-  std::vector<uint32_t> eventStartByte;
-  uint64_t nEventsPerBoard[MAX_BOARDS] = {0};
+  std::vector<uint64_t> eventStartByte;
+  uint64_t nEventsPerBoard[MAX_BOARD_ID + 1] = {0};
   uint64_t nEvents = 0;
   uint64_t startAcqMs;
   uint8_t nBoards = 0;
   AcquisitionMode acquisitionMode;
+  // Corrupted regions skipped in recovery mode (first byte, first byte of the next event)
+  std::vector<std::pair<uint64_t, uint64_t>> skippedBytes;
 };
 
-// Single event informations (all info of all acq modes)
-struct Event {
+// Event of spectroscopy mode: only what is written to the ROOT file
+struct SpectroscopyEvent {
+  std::array<uint16_t, NCHANNELS> lgPha;
+  std::array<uint16_t, NCHANNELS> hgPha;
+  uint64_t triggerId;
+  double triggerTimeStamp;
+  uint8_t boardId;
+  bool operator<(const SpectroscopyEvent& lhs) const { return this->triggerId < lhs.triggerId; }
+};
+
+// Event of spectroscopy and timing mode
+struct SpectroscopyTimingEvent {
   std::array<uint16_t, NCHANNELS> lgPha;
   std::array<uint16_t, NCHANNELS> hgPha;
   std::array<uint32_t, NCHANNELS> toa;
@@ -43,7 +69,45 @@ struct Event {
   uint64_t triggerId;
   double triggerTimeStamp;
   uint8_t boardId;
-  bool operator<(const Event& lhs) const { return this->triggerId < lhs.triggerId; }
+  bool operator<(const SpectroscopyTimingEvent& lhs) const { return this->triggerId < lhs.triggerId; }
+};
+
+// Board-aligned output (SiPMEvents tree, -a): complete triggers built from the events given in order of
+// trigger id. Created in the output file, next to SiPMData
+struct AlignedWriter {
+  TTree tree;
+  uint16_t HighGainADC[MAX_BOARDS * NCHANNELS] = {0};
+  uint16_t LowGainADC[MAX_BOARDS * NCHANNELS] = {0};
+  uint64_t triggerId = 0;
+  double triggerTime = 0;
+  uint8_t boardMask = 0;
+  uint32_t nFragments = 0; // Fragments of the current trigger
+  AlignedWriter();
+  AlignedWriter(const AlignedWriter&) = delete;
+  AlignedWriter& operator=(const AlignedWriter&) = delete;
+  template <typename EventType> void add(const EventType&);
+  void fill();
+  void finish();
+};
+
+// Decoding threads, started once: each job is split in one range of indices per worker.
+// start() returns at once (the caller can write while the workers decode), wait() blocks until the job is done
+struct WorkerPool {
+  std::vector<std::thread> workers;
+  std::mutex mutex;
+  std::condition_variable wake, done;
+  std::function<void(uint64_t, uint64_t)> job; // Called as job(begin, end)
+  uint64_t nItems = 0;
+  uint64_t generation = 0; // Jobs started so far
+  unsigned pending = 0;    // Workers still running the current job
+  bool stop = false;
+  explicit WorkerPool(const unsigned);
+  WorkerPool(const WorkerPool&) = delete;
+  WorkerPool& operator=(const WorkerPool&) = delete;
+  ~WorkerPool();
+  void start(const uint64_t, std::function<void(uint64_t, uint64_t)>);
+  void wait();
+  void work(const unsigned);
 };
 
 // Struct used only in root file writing
@@ -52,20 +116,40 @@ typedef struct {
   uint8_t nBoards, acquisitionMode;
 } RootFileInfo;
 
-uint32_t getFileSize(const std::string&);
+// Whole raw file, memory-mapped: pages are read when parsed and dropped by the kernel
+// when needed, so memory does not grow with the file size. 64 bit offsets (files > 4 GB)
+// Compressed files (.bz2, .zst) are first decompressed into a deleted temporary file next to them, then mapped
+struct RawData {
+  const char* data = nullptr; // Mapping of the raw data (of the decompressed temporary file if archived)
+  uint64_t size = 0;
+  explicit RawData(const std::string&);
+  RawData(const RawData&) = delete;
+  RawData& operator=(const RawData&) = delete;
+  ~RawData();
+  const char& operator[](const uint64_t i) const { return data[i]; }
+};
+
+// Raw files archived by convert.py (bzip2 or zstd)
+bool isCompressed(const std::string&);
+std::string rawFileName(const std::string&);
+void writeAll(const int, const char*, size_t);
+uint64_t decompressBz2(std::ifstream&, const int);
+uint64_t decompressZstd(std::ifstream&, const int);
 
-std::vector<char> readRawData(const std::string&, const uint32_t);
+// Recovery mode: resynchronisation after a corrupted region
+bool validEvent(const RawData&, const uint64_t, const AcquisitionMode);
+uint64_t findNextEvent(const RawData&, const uint64_t, const AcquisitionMode, const uint64_t, const bool);
 
 // Wrappers functions
-std::vector<Event> parseData(const std::vector<char>&, const FileInfo&);
-void writeDataToRoot(const std::vector<Event>&, const FileInfo&, const std::string&);
+void writeDataToRoot(const RawData&, const FileInfo&, const std::string&);
 
-// Specific parsing functions
-std::vector<Event> parseSpectroscopyData(const std::vector<char>&, const FileInfo&);
-std::vector<Event> parseSpectroscopyTimingData(const std::vector<char>&, const FileInfo&);
+// Specific decoding functions (one event)
+SpectroscopyEvent decodeSpectroscopyEvent(const RawData&, const uint64_t);
+SpectroscopyTimingEvent decodeSpectroscopyTimingEvent(const RawData&, const uint64_t);
 
-void writeSpectroscopyToRoot(const std::vector<Event>&, const FileInfo&, const std::string&);
-void writeSpectroscopyTimingToRoot(const std::vector<Event>&, const FileInfo&, const std::string&);
+// Specific writing functions (decode the events while writing them)
+void writeSpectroscopyToRoot(const RawData&, const FileInfo&, const std::string&);
+void writeSpectroscopyTimingToRoot(const RawData&, const FileInfo&, const std::string&);
 
 void logging(const std::string&, const Verbose);
 
@@ -84,5 +168,9 @@ void printHelp() {
   std::cout << "= CAEN FERS 5200 Data Converter =" << std::endl;
   std::cout << "=================================" << std::endl;
   std::cout << "\nINVOKE WITH: ./dataconverter filename.dat" << std::endl;
+  std::cout << "             (also filename.dat.bz2 or filename.dat.zst)" << std::endl;
+  std::cout << "OPTIONS:     v, vv, vvv, vvvv verbosity; -jN decoding threads (default: all cores)" << std::endl;
+  std::cout << "             -a also write the complete triggers (SiPMEvents, all boards aligned)" << std::endl;
+  std::cout << "             -r recovery mode: skip corrupted regions instead of stopping" << std::endl;
   std::cout << "edoardo.proserpio@gmail.com" << std::endl;
 }
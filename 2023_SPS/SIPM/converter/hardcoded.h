@@ -9,6 +9,8 @@ enum class AcquisitionMode { kSpectroscopy, kTiming, kSpectroscopyTiming, kCount
 
 // Maximum number of boards (in this case 5 boards used at test beam)
 static constexpr uint8_t MAX_BOARDS = 5;
+// Largest board ID accepted in a file (a FERS chain has at most 16 boards)
+static constexpr uint8_t MAX_BOARD_ID = 15;
 // Number of channels read out by each board
 static constexpr uint8_t NCHANNELS = 64;
 // Size on the file header (14 bytes as per CAEN manual)
@@ -21,6 +23,16 @@ static constexpr uint32_t EVENT_HEADER_SIZE[] = {27, 21, 27, 27};
 // counting)
 static constexpr uint32_t EVENTS_SIZE[] = {6, 7, 12, 5};
 
+// Events decoded at a time (split over the threads) while the previous ones are written
+static constexpr uint64_t DECODE_BLOCK_EVENTS = 1 << 14;
+// Events sorted in memory at a time before being spilled to disk (external sort)
+static constexpr uint64_t SORT_RUN_EVENTS = 1 << 17;
+// Events read at a time from each spilled run while merging
+static constexpr uint64_t SORT_READ_EVENTS = 1 << 10;
+// Recovery mode: trigger ids accepted around the last good one when resynchronising
+// (boards are not written in order), plus one per event header that fits in the skipped bytes
+static constexpr uint64_t RESYNC_TRIGGER_WINDOW = 1000;
+
 // Map from channel number to fiber in calorimeter
 static constexpr uint8_t MAPPING_LUT[] = {
     0,  40, 8,  32, // 0 - 3
@@ -1,15 +1,23 @@
 import os
 import sys
 import subprocess
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 import uproot
 from glob import glob
 from tqdm import tqdm
 import numpy as np
 from scipy.io import savemat
+from functools import partial
+import alignedstore
 
 
 ntuplePath = "/afs/cern.ch/user/i/ideadr/cernbox/TB2021_H8/rawNtupleSiPM"
 
+MAXBOARDS = 5
+# Amount of SiPMData read at once when streaming
+STEPSIZE = "200 MB"
+
 
 def getFiles():
     files = glob(ntuplePath + "/*list.root")
@@ -33,9 +41,57 @@ def getFilesToAlign():
     return list(toAlign)
 
 
-def runAlignement(fname):
+def alignFragments(tid, bid, hg, lg):
+    """Group the board fragments by TriggerId into (20, 16, nEvents) matrices.
+    Only the first MAXBOARDS fragments of each trigger are used and, if a board
+    appears twice in a trigger, its last fragment is kept."""
+    # Sort with respect to tid (stable: the fragments of a trigger stay in file order)
+    sortIdx = np.argsort(tid, kind="stable")
+    hg = hg[sortIdx]
+    lg = lg[sortIdx]
+    bid = bid[sortIdx]
+    tid = tid[sortIdx]
+    tiduniq, first, event = np.unique(tid, return_index=True, return_inverse=True)
+
+    nEvents = tiduniq.size
+
+    # Position of each fragment inside its trigger
+    rank = np.arange(tid.size) - first[event]
+    keep = np.flatnonzero(rank < MAXBOARDS)
+    # Last fragment of each (trigger, board) pair
+    pair = event[keep] * 256 + bid[keep]
+    _, lastFromEnd = np.unique(pair[::-1], return_index=True)
+    keep = keep[keep.size - 1 - lastFromEnd]
+
+    hgMatrix = np.zeros((20, 16, nEvents), dtype=np.uint16)
+    lgMatrix = np.zeros((20, 16, nEvents), dtype=np.uint16)
+
+    # Board b fills rows 4b - 4b+3, i.e. channels 64b - 64b+63 of the flattened (row, column)
+    hgMatrix.reshape(MAXBOARDS, 64, nEvents)[bid[keep], :, event[keep]] = hg[keep]
+    lgMatrix.reshape(MAXBOARDS, 64, nEvents)[bid[keep], :, event[keep]] = lg[keep]
+    return hgMatrix, lgMatrix, tiduniq
+
+
+def triggerMatrix(adc):
+    """(nEvents, 320) arrays of the complete triggers (SiPMEvents, dataconverter -a) as a (20, 16, nEvents) matrix:
+    the converter already stores them as [board][channel], i.e. board b in rows 4b - 4b+3"""
+    return np.ascontiguousarray(np.asarray(adc, dtype=np.uint16).T).reshape(20, 16, -1)
+
+
+def runAlignement(fname, store=False):
     # Load data
     with uproot.open(fname) as f:
+        if "SiPMEvents" in f:
+            # Already aligned by the converter
+            events = f["SiPMEvents"]
+            tiduniq = np.array(events["TriggerId"], dtype=np.uint64)
+            if tiduniq.size == 0 or tiduniq.max() == 0:
+                tqdm.write(f"Error in file {fname}. Skipping")
+                return None
+            hgMatrix = triggerMatrix(events["HighGainADC"].array(library="np"))
+            lgMatrix = triggerMatrix(events["LowGainADC"].array(library="np"))
+            saveAligned(fname[:-5], hgMatrix, lgMatrix, tiduniq, store)
+            return
         tid = np.array(f["SiPMData"]["TriggerId"], dtype=np.uint64)
         if tid.max() == 0:
             tqdm.write(f"Error in file {fname}. Skipping")
@@ -44,59 +100,140 @@ def runAlignement(fname):
         lg = np.array(f["SiPMData"]["LowGainADC"], dtype=np.uint16)
         bid = np.array(f["SiPMData"]["BoardId"], dtype=np.uint8)
 
-    # Sort with respect to tid
-    sortIdx = np.argsort(tid)
-    hg = hg[sortIdx]
-    lg = lg[sortIdx]
-    bid = bid[sortIdx]
-    tid = tid[sortIdx]
-    tiduniq = np.unique(tid)
+    hgMatrix, lgMatrix, tiduniq = alignFragments(tid, bid, hg, lg)
+    saveAligned(fname[:-5], hgMatrix, lgMatrix, tiduniq, store)
 
-    nEvents = tiduniq.size
 
-    hgMatrix = np.zeros((20, 16, nEvents), dtype=np.uint16)
-    lgMatrix = np.zeros((20, 16, nEvents), dtype=np.uint16)
+def streamAlignement(fname, stepSize=STEPSIZE):
+    """Align a file chunk by chunk with bounded memory.
+    A first pass over TriggerId gives the event index of every trigger, so the
+    fragments of each chunk are written straight into the memory-mapped aligned
+    store, whichever chunk the other fragments of the same trigger are in.
+    The .npz is then compressed from the store; no .mat is written."""
+    with uproot.open(fname) as f:
+        if "SiPMEvents" in f:
+            return streamTriggers(fname, f["SiPMEvents"], stepSize)
+        tree = f["SiPMData"]
+        # Unique IDs of each chunk, merged once at the end
+        tidparts = [np.zeros(0, dtype=np.uint64)]
+        for chunk in tree.iterate(["TriggerId"], step_size=stepSize, library="np"):
+            tidparts.append(np.unique(chunk["TriggerId"].astype(np.uint64)))
+        tiduniq = np.unique(np.concatenate(tidparts))
+        if tiduniq.size == 0 or tiduniq.max() == 0:
+            tqdm.write(f"Error in file {fname}. Skipping")
+            return None
 
-    # Align data
-    for i, t in enumerate(
-        tqdm(
-            tiduniq,
-            leave=False,
-            dynamic_ncols=True,
-            position=1,
-            colour="RED",
-            desc=fname.rsplit("/", 1)[-1],
-        )
-    ):
-        # tid is sorted!
-        firstidx = np.searchsorted(tid, t)
-        nBoards = np.count_nonzero(tid[firstidx: firstidx + 5] == t)
-        boards = bid[firstidx: firstidx + nBoards]
-        for j in range(nBoards):
-            b = boards[j]
-            hgMatrix[b * 4: b * 4 + 4, :, i] = hg[firstidx + j].reshape(4, 16)
-            lgMatrix[b * 4: b * 4 + 4, :, i] = lg[firstidx + j].reshape(4, 16)
+        nEvents = tiduniq.size
+        store = fname[:-5] + alignedstore.STORE_SUFFIX
+        os.makedirs(store, exist_ok=True)
+        np.save(os.path.join(store, "tid.npy"), tiduniq)
+        hgMatrix = np.lib.format.open_memmap(os.path.join(store, "hg.npy"), "w+", np.uint16, (20, 16, nEvents))
+        lgMatrix = np.lib.format.open_memmap(os.path.join(store, "lg.npy"), "w+", np.uint16, (20, 16, nEvents))
+
+        # Fragments of each trigger already read, for the MAXBOARDS cut of alignFragments
+        seen = np.zeros(nEvents, dtype=np.int64)
+        for chunk in tree.iterate(["TriggerId", "BoardId", "HighGainADC", "LowGainADC"], step_size=stepSize, library="np"):
+            event = np.searchsorted(tiduniq, chunk["TriggerId"].astype(np.uint64))
+            bid = chunk["BoardId"].astype(np.uint8)
+            keep = chunkFragments(event, bid, seen)
+            hgMatrix.reshape(MAXBOARDS, 64, nEvents)[bid[keep], :, event[keep]] = chunk["HighGainADC"][keep]
+            lgMatrix.reshape(MAXBOARDS, 64, nEvents)[bid[keep], :, event[keep]] = chunk["LowGainADC"][keep]
+        hgMatrix.flush()
+        lgMatrix.flush()
+
+    # np.savez_compressed streams memory-mapped arrays in buffered blocks
+    np.savez_compressed(fname[:-5], hg=hgMatrix, lg=lgMatrix, tid=tiduniq)
+
+
+def chunkFragments(event, bid, seen):
+    """Fragments of a chunk to write, with the rules of alignFragments: only the first MAXBOARDS
+    fragments of each trigger (counted in seen over the chunks, updated here) and, in the chunk,
+    the last fragment of each (trigger, board) pair (a later chunk overwrites the earlier ones)"""
+    order = np.argsort(event, kind="stable")
+    _, first, inverse = np.unique(event[order], return_index=True, return_inverse=True)
+    rank = np.empty(event.size, dtype=np.int64)
+    rank[order] = np.arange(event.size) - first[inverse]
+    rank += seen[event]
+    np.add.at(seen, event, 1)
+    keep = np.flatnonzero(rank < MAXBOARDS)
+    pair = event[keep].astype(np.int64) * 256 + bid[keep]
+    _, lastFromEnd = np.unique(pair[::-1], return_index=True)
+    return keep[keep.size - 1 - lastFromEnd]
+
+
+def streamTriggers(fname, events, stepSize=STEPSIZE):
+    """streamAlignement of a file with the complete triggers (SiPMEvents): each chunk is
+    already a block of consecutive events"""
+    nEvents = events.num_entries
+    if nEvents == 0 or np.max(events["TriggerId"].array(library="np")) == 0:
+        tqdm.write(f"Error in file {fname}. Skipping")
+        return None
+    store = fname[:-5] + alignedstore.STORE_SUFFIX
+    os.makedirs(store, exist_ok=True)
+    tiduniq = np.lib.format.open_memmap(os.path.join(store, "tid.npy"), "w+", np.uint64, (nEvents,))
+    hgMatrix = np.lib.format.open_memmap(os.path.join(store, "hg.npy"), "w+", np.uint16, (20, 16, nEvents))
+    lgMatrix = np.lib.format.open_memmap(os.path.join(store, "lg.npy"), "w+", np.uint16, (20, 16, nEvents))
+    start = 0
+    for chunk in events.iterate(["TriggerId", "HighGainADC", "LowGainADC"], step_size=stepSize, library="np"):
+        stop = start + chunk["TriggerId"].size
+        tiduniq[start:stop] = chunk["TriggerId"]
+        hgMatrix[:, :, start:stop] = triggerMatrix(chunk["HighGainADC"])
+        lgMatrix[:, :, start:stop] = triggerMatrix(chunk["LowGainADC"])
+        start = stop
+    for array in (tiduniq, hgMatrix, lgMatrix):
+        array.flush()
     np.savez_compressed(fname[:-5], hg=hgMatrix, lg=lgMatrix, tid=tiduniq)
-    savemat(
-        fname[:-5] + ".mat",
-        {
-            "matrixHighGainSiPM": hgMatrix,
-            "matrixLowGainSiPM": lgMatrix,
-            "triggerId": tiduniq,
-        },
-        do_compression=True,
-        oned_as="row",
-    )
 
 
-def alignAll(fnames):
-    for f in tqdm(fnames, dynamic_ncols=True, position=0, colour="GREEN"):
-        runAlignement(f)
+def saveAligned(base, hgMatrix, lgMatrix, tiduniq, store=False):
+    """Write the .npz and .mat outputs (and the aligned store) at the same time (zlib releases the GIL)"""
+    with ThreadPoolExecutor(3) as executor:
+        jobs = [
+            executor.submit(np.savez_compressed, base, hg=hgMatrix, lg=lgMatrix, tid=tiduniq),
+            executor.submit(
+                savemat,
+                base + ".mat",
+                {
+                    "matrixHighGainSiPM": hgMatrix,
+                    "matrixLowGainSiPM": lgMatrix,
+                    "triggerId": tiduniq,
+                },
+                do_compression=True,
+                oned_as="row",
+            ),
+        ]
+        if store:
+            jobs.append(executor.submit(alignedstore.save, base, hgMatrix, lgMatrix, tiduniq))
+        for job in jobs:
+            job.result()
+
+
+def alignAll(fnames, nWorkers=mp.cpu_count(), store=False, stream=False):
+    # One file per worker, each file holds its own data in memory
+    align = streamAlignement if stream else partial(runAlignement, store=store)
+    with mp.Pool(max(1, min(nWorkers, len(fnames))), maxtasksperchild=4) as pool:
+        list(
+            tqdm(
+                pool.imap_unordered(align, fnames),
+                total=len(fnames),
+                unit="file",
+                dynamic_ncols=True,
+                position=0,
+                colour="GREEN",
+            )
+        )
 
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Align the FERS board fragments of the new raw SiPM ntuples by TriggerId.")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=mp.cpu_count(), help="Number of files aligned in parallel")
+    parser.add_argument("--store", dest="store", action="store_true", help="Also write the uncompressed, memory-mappable aligned store (<run>.sipm)")
+    parser.add_argument("--stream", dest="stream", action="store_true", help="Align chunk by chunk with bounded memory (writes the aligned store and the .npz, no .mat)")
+    par = parser.parse_args()
+
     toAlign = getFilesToAlign()
     for file in toAlign:
         tqdm.write(file)
 
-    alignAll(toAlign)
+    alignAll(toAlign, par.jobs, par.store, par.stream)
@@ -0,0 +1,24 @@
+import os
+import numpy as np
+
+# Aligned store: directory <run>.sipm with uncompressed hg.npy, lg.npy and tid.npy.
+# The (20, 16, nEvents) matrices are C ordered, so the events of one channel are
+# contiguous on disk and a memory-mapped channel is read with a single sequential read.
+STORE_SUFFIX = ".sipm"
+
+
+def save(base, hgMatrix, lgMatrix, tiduniq):
+    store = base + STORE_SUFFIX
+    os.makedirs(store, exist_ok=True)
+    np.save(os.path.join(store, "hg.npy"), hgMatrix)
+    np.save(os.path.join(store, "lg.npy"), lgMatrix)
+    np.save(os.path.join(store, "tid.npy"), tiduniq)
+
+
+def load(fname, key):
+    """Return "hg", "lg" or "tid" from an aligned .npz archive or from an aligned store.
+    From a store the array is memory-mapped: channel data are read from disk only when used."""
+    if fname.endswith(".npz"):
+        with np.load(fname) as f:
+            return f[key]
+    return np.load(os.path.join(fname, key + ".npy"), mmap_mode="r")
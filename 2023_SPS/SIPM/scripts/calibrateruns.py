@@ -0,0 +1,202 @@
+import os
+import re
+import argparse
+import warnings
+from glob import glob
+import multiprocessing as mp
+from functools import partial
+import numpy as np
+from tqdm import tqdm
+import alignedstore
+import histograms
+import pedestals
+import dpp
+import lgcalibration
+
+# Constants of a run, saved as <name>.npy in its cache directory (same names as the single scripts)
+CONSTANTS = ["pedestalsHg", "dppHg", "dppHgStatus", "pedestalsLg", "dppLg"]
+# Per-channel time series: "runs" (nRuns,) and every constant as (nRuns, 20, 16)
+SERIES = "calibrations.npz"
+# HG histograms of a run, kept in its cache directory to compare the next runs with
+HISTOGRAMS = "histograms.npz"
+# Warm start: channels whose HG spectrum is compatible with the previous run
+# (chi2 test p-value above PVALUE) keep its constants and are not refitted
+PVALUE = 0.01
+
+
+def runNumber(fname):
+    match = re.search(r"Run(\d+)", os.path.basename(fname.rstrip("/")))
+    if match is None:
+        raise ValueError(f"No run number in {fname}")
+    return int(match.group(1))
+
+
+def cached(rundir, names, force):
+    """Constants already computed for this run, or None if one of them is missing"""
+    paths = [os.path.join(rundir, name + ".npy") for name in names]
+    if force or not all(map(os.path.exists, paths)):
+        return None
+    return [np.load(path) for path in paths]
+
+
+def save(rundir, names, arrays):
+    for name, array in zip(names, arrays):
+        np.save(os.path.join(rundir, name), array)
+    return arrays
+
+
+def previousRun(outdir, run):
+    """Cache directory of the last run calibrated before run, or None"""
+    needed = [name + ".npy" for name in CONSTANTS[:3]] + [HISTOGRAMS]
+    previous = []
+    for rundir in glob(os.path.join(outdir, "Run*")):
+        match = re.fullmatch(r"Run(\d+)", os.path.basename(rundir))
+        if match and int(match.group(1)) < run and all(os.path.exists(os.path.join(rundir, name)) for name in needed):
+            previous.append((int(match.group(1)), rundir))
+    return max(previous)[1] if previous else None
+
+
+def calibrateRun(fname, outdir, binned=False, force=False, warm=False, nWorkers=1):
+    """Pedestals, DPP and LG calibration of one run, each step cached in <outdir>/Run<N>.
+    From a raw ntuple (.root) only the HG constants are derived: the LG ones need the events.
+    With warm=True the HG constants are seeded from the last run calibrated before this one,
+    and the channels with an unchanged spectrum keep its constants.
+    The DPP fits run over nWorkers processes (1 when already in a worker)."""
+    run = runNumber(fname)
+    rundir = os.path.join(outdir, f"Run{run}")
+    os.makedirs(rundir, exist_ok=True)
+    counts = histograms.load(fname, "hg")
+    np.savez_compressed(os.path.join(rundir, HISTOGRAMS), hg=counts)
+
+    previous = None
+    prevdir = previousRun(outdir, run) if warm else None
+    if prevdir is not None:
+        previous = dict(zip(CONSTANTS[:3], cached(prevdir, CONSTANTS[:3], False)))
+        with np.load(os.path.join(prevdir, HISTOGRAMS)) as f:
+            pvalue = histograms.chi2Test(counts, f["hg"])
+        unchanged = (pvalue > PVALUE) & (previous["dppHgStatus"] == dpp.STATUS_OK)
+        np.save(os.path.join(rundir, "unchanged"), unchanged)
+        tqdm.write(f"Run {run}: {unchanged.sum()} channels unchanged since {os.path.basename(prevdir)}")
+
+    constants = {}
+    names = ["pedestalsHg"]
+    steps = cached(rundir, names, force)
+    if steps is None:
+        if previous is None:
+            pedestalHg = pedestals.estimatePedestals(counts)[0]
+        else:
+            pedestalHg = pedestals.estimatePedestals(counts, previous["pedestalsHg"])[0]
+            pedestalHg = np.where(unchanged, previous["pedestalsHg"], pedestalHg)
+        steps = save(rundir, names, [pedestalHg])
+    constants.update(zip(names, steps))
+
+    names = ["dppHg", "dppHgStatus"]
+    steps = cached(rundir, names, force)
+    if steps is None:
+        if previous is None:
+            dppHg, status, _ = dpp.fitAll(counts, constants["pedestalsHg"], binned, nWorkers)
+        else:
+            dppHg, status, _ = dpp.fitAll(
+                counts, constants["pedestalsHg"], binned, nWorkers, seeds=previous["dppHg"], channels=~unchanged
+            )
+            dppHg[unchanged] = previous["dppHg"][unchanged]
+            status[unchanged] = previous["dppHgStatus"][unchanged]
+        steps = save(rundir, names, [dppHg, status])
+    constants.update(zip(names, steps))
+
+    names = ["pedestalsLg", "dppLg"]
+    steps = cached(rundir, names, force)
+    if steps is None:
+        if fname.endswith(".root"):
+            steps = [np.full((20, 16), np.nan)] * 2
+        else:
+            sums = lgcalibration.lineSums(
+                alignedstore.load(fname, "hg"),
+                alignedstore.load(fname, "lg"),
+                constants["pedestalsHg"],
+                constants["dppHg"],
+            )
+            dppLg, pedestalLg, _ = lgcalibration.lineFit(sums)
+            steps = save(rundir, names, [pedestalLg, dppLg])
+    constants.update(zip(names, steps))
+    return run, constants
+
+
+def updateSeries(fname, results):
+    """Merge the constants of the runs in results into the time series in fname"""
+    series = {}
+    if os.path.exists(fname):
+        with np.load(fname) as f:
+            series = {run: {name: f[name][i] for name in CONSTANTS} for i, run in enumerate(f["runs"])}
+    series.update(results)
+    runs = np.array(sorted(series))
+    np.savez(fname, runs=runs, **{name: np.stack([series[run][name] for run in runs]) for name in CONSTANTS})
+    return runs
+
+
+def periodConstants(fname, first, last):
+    """Per-channel median of the constants of the runs first - last.
+    Channels without a good DPP fit are not used for the DPP-dependent constants."""
+    with np.load(fname) as f:
+        period = (f["runs"] >= first) & (f["runs"] <= last)
+        if not period.any():
+            raise ValueError(f"No calibrated run between {first} and {last}")
+        good = f["dppHgStatus"][period] == dpp.STATUS_OK
+        constants = {}
+        for name in CONSTANTS:
+            if name == "dppHgStatus":
+                continue
+            values = f[name][period] if name == "pedestalsHg" else np.where(good, f[name][period], np.nan)
+            # Channels missing in all the runs stay NaN
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                constants[name] = np.nanmedian(values, axis=0)
+    return constants
+
+
+def calibrateAll(fnames, outdir, nWorkers=mp.cpu_count(), binned=False, force=False, warm=False):
+    results = {}
+    if warm:
+        # Each run starts from the previous one: runs in order, channels fitted in parallel
+        for fname in tqdm(sorted(fnames, key=runNumber), unit="run", dynamic_ncols=True):
+            run, constants = calibrateRun(fname, outdir, binned, force, warm, nWorkers)
+            results[run] = constants
+        return updateSeries(os.path.join(outdir, SERIES), results)
+
+    with mp.Pool(nWorkers) as pool:
+        for run, constants in tqdm(
+            pool.imap_unordered(partial(calibrateRun, outdir=outdir, binned=binned, force=force), fnames),
+            total=len(fnames),
+            unit="run",
+            dynamic_ncols=True,
+        ):
+            results[run] = constants
+    return updateSeries(os.path.join(outdir, SERIES), results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SiPM calibration of many runs, stored as a per-channel time series")
+    parser.add_argument("runs", nargs="*", help="aligned .npz/stores or raw ntuples (Run<N>_...)")
+    parser.add_argument("-o", "--output", default="calibrations", help="directory with the per-run caches and the time series")
+    parser.add_argument("-j", "--jobs", type=int, default=mp.cpu_count(), help="parallel processes (runs, or the channels of a run with --warm)")
+    parser.add_argument("--binned", action="store_true", help="binned DPP fits")
+    parser.add_argument("--force", action="store_true", help="recompute cached constants")
+    parser.add_argument(
+        "--warm", action="store_true", help="seed each run from the previous one and skip the unchanged channels"
+    )
+    parser.add_argument(
+        "--period", type=int, nargs=2, metavar=("FIRST", "LAST"), help="write the median constants of runs FIRST - LAST"
+    )
+    args = parser.parse_args()
+
+    if args.runs:
+        runs = calibrateAll(args.runs, args.output, args.jobs, args.binned, args.force, args.warm)
+        print(f"{len(runs)} runs in {os.path.join(args.output, SERIES)}")
+
+    if args.period:
+        first, last = args.period
+        perioddir = os.path.join(args.output, f"Run{first}-{last}")
+        os.makedirs(perioddir, exist_ok=True)
+        for name, values in periodConstants(os.path.join(args.output, SERIES), first, last).items():
+            np.save(os.path.join(perioddir, name), values)
+        print(f"Constants of runs {first} - {last} saved in {perioddir}")
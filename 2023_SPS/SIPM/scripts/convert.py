@@ -1,6 +1,8 @@
-import os, sys, subprocess
+import os, sys, subprocess, shutil
 from glob import glob
+from time import time
 import multiprocessing as mp
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
 
@@ -14,34 +16,80 @@ def getFiles():
     return files
 
 
-def moveConverted(fnames):
-    toMove = glob(rawdataPath + "/Run*.root")
-    for f in toMove:
-        newfname = rawntuplePath +"/"+ os.path.basename(f)
-        os.rename(f,newfname)
-    for f in fnames:
-        p = subprocess.Popen(["bzip2", "-z", f])
-        p.wait()
+def moveConverted(fname):
+    root = os.path.splitext(fname)[0] + ".root"
+    shutil.move(root, rawntuplePath + "/" + os.path.basename(root))
 
 
-def runConversion(fname):
-    p = subprocess.Popen(["./dataconverter", fname])
-    p.wait()
+def compressCommand(fname, nThreads, codec="bz2"):
+    # zstd (.zst) is much faster to decompress when the raw data are read again
+    if codec == "zstd":
+        return ["zstd", "-q", "--rm", f"-T{nThreads}", fname]
+    # Multi-threaded compressors writing standard .bz2 files, if installed
+    if shutil.which("lbzip2"):
+        return ["lbzip2", "-z", "-n", str(nThreads), fname]
+    if shutil.which("pbzip2"):
+        return ["pbzip2", "-z", f"-p{nThreads}", fname]
+    return ["bzip2", "-z", fname]
 
 
-def convertAll(fnames):
-    # Run conversion .dat -> .root
-    with mp.Pool(mp.cpu_count(), maxtasksperchild=4) as pool:
-        list(
-            tqdm(
-                pool.imap_unordered(runConversion, fnames),
-                total=len(fnames),
-                unit="file",
-                dynamic_ncols=True,
-                position=0,
-                colour="GREEN",
-            )
-        )
+def compress(fname, nThreads, codec="bz2"):
+    subprocess.run(compressCommand(fname, nThreads, codec), check=True)
+
+
+def runConversion(fname, nThreads=1, aligned=False, recover=False):
+    options = (["-a"] if aligned else []) + (["-r"] if recover else [])
+    subprocess.run(["./dataconverter", fname, f"-j{nThreads}"] + options, check=True)
+
+
+def then(future, pool, fn, *args):
+    """Future of fn(*args), submitted to pool as soon as future is done.
+    If future failed, fn is not run and its exception is passed on."""
+    result = Future()
+
+    def forward(done):
+        if done.exception() is not None:
+            result.set_exception(done.exception())
+        else:
+            result.set_result(done.result())
+
+    def submit(done):
+        if done.exception() is not None:
+            result.set_exception(done.exception())
+        else:
+            pool.submit(fn, *args).add_done_callback(forward)
+
+    future.add_done_callback(submit)
+    return result
+
+
+def convertAll(fnames, nConvert=mp.cpu_count(), nMove=1, nCompress=2, nThreads=max(1, mp.cpu_count() // 2), codec="bz2", convertThreads=1, aligned=False, recover=False):
+    """Convert .dat -> .root, move the ntuple and compress the .dat of every file.
+    Each file goes to the next step as soon as its previous one is done; every step has
+    its own pool (nConvert, nMove, nCompress), so conversions never wait for compressions."""
+    start = time()
+    failed = []
+    with ThreadPoolExecutor(nConvert) as converters, ThreadPoolExecutor(nMove) as movers, ThreadPoolExecutor(
+        nCompress
+    ) as compressors:
+        done = {}
+        for fname in fnames:
+            converted = converters.submit(runConversion, fname, convertThreads, aligned, recover)
+            moved = then(converted, movers, moveConverted, fname)
+            done[then(moved, compressors, compress, fname, nThreads, codec)] = fname
+        for future in tqdm(
+            as_completed(done),
+            total=len(done),
+            unit="file",
+            dynamic_ncols=True,
+            position=0,
+            colour="GREEN",
+        ):
+            if future.exception() is not None:
+                failed.append(done[future])
+                tqdm.write(f"Error in file {done[future]}: {future.exception()}")
+    print(f"{len(fnames) - len(failed)} of {len(fnames)} files converted, moved and compressed in {time() - start:.1f} s")
+    return failed
 
 
 if __name__ == "__main__":
@@ -49,6 +97,13 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='This script onverts the binary FERs files from the Janus software to root ntuples.')
     parser.add_argument('-i', '--inputRawDataPath', dest='rawdataPath', default='/afs/cern.ch/user/i/ideadr/scratch/TB2023_H8/rawData', help='Input path of raw data')
     parser.add_argument('-o', '--outputRawNtuplePath', dest='rawntuplePath', default='/afs/cern.ch/user/i/ideadr/scratch/TB2023_H8/rawNtupleSiPM', help='Output path for the raw ntuples')
+    parser.add_argument('-j', '--jobs', dest='nConvert', type=int, default=mp.cpu_count(), help='Conversions running at the same time')
+    parser.add_argument('--convertThreads', dest='convertThreads', type=int, default=1, help='Decoding threads of each conversion')
+    parser.add_argument('--aligned', dest='aligned', action='store_true', help='Also write the complete triggers (SiPMEvents), read directly by align.py')
+    parser.add_argument('--recover', dest='recover', action='store_true', help='Skip corrupted regions of the raw files instead of failing the conversion')
+    parser.add_argument('--compressJobs', dest='nCompress', type=int, default=2, help='Compressions running at the same time')
+    parser.add_argument('--compressThreads', dest='nThreads', type=int, default=max(1, mp.cpu_count() // 2), help='Threads of each compression (lbzip2/pbzip2/zstd only)')
+    parser.add_argument('--codec', choices=['bz2', 'zstd'], default='bz2', help='Compression of the converted raw files (the converter reads both)')
     
     par  = parser.parse_args()
     global rawdataPath 
@@ -68,5 +123,4 @@ if __name__ == "__main__":
 
     print(toConvert)
 
-    convertAll(toConvert)
-    moveConverted(toConvert)
+    convertAll(toConvert, par.nConvert, 1, par.nCompress, par.nThreads, par.codec, par.convertThreads, par.aligned, par.recover)
@@ -2,11 +2,15 @@ import numpy as np
 from matplotlib import pyplot as plt
 import numba as nb
 import sys, mplhep
-from iminuit.cost import ExtendedUnbinnedNLL
+import multiprocessing as mp
+from iminuit.cost import ExtendedUnbinnedNLL, ExtendedBinnedNLL
 from iminuit import Minuit
-from numba_stats import norm_pdf
+from numba_stats import norm_pdf, norm_cdf
 from scipy.stats import norm
 from time import time
+from tqdm import tqdm
+import histograms
+import plotbook
 
 plt.style.use(mplhep.style.ATLAS)
 
@@ -22,108 +26,223 @@ def gauss3(x, par):
     ] * norm_pdf(x, par[7], par[8])
 
 
-plt.style.use(mplhep.style.ATLAS)
+@nb.njit(fastmath=True, nogil=True)
+def gauss3cdf(xe, par):
+    return par[0] * norm_cdf(xe, par[1], par[2]) + par[3] * norm_cdf(xe, par[4], par[5]) + par[6] * norm_cdf(
+        xe, par[7], par[8]
+    )
 
-fname = sys.argv[1]
 
 NPEAKS = 3
 DPPESTIM = 26
 DPPWIDTH = 5
-
-with np.load(fname) as f:
-    matrix = f["hg"]
-
-pedestals = np.load("pedestalsHg.npy")
-
-dpps = np.empty_like(pedestals)
-
-if GUI:
-    fig, ax = plt.subplots()
-for r in range(matrix.shape[0]):
-    if r % 4 == 0:
-        print()
-    for c in range(matrix.shape[1]):
-        channeldata = matrix[r, c, :]
-        channeldata = channeldata[channeldata > 0] - pedestals[r, c]
-        y, x = np.histogram(channeldata, np.arange(-50, 400, 2))
-        x = (x[1:] + x[:-1]) * 0.5
-        prevMu = DPPESTIM
-        prevDpp = DPPESTIM
-
-        fits = []
-        for i in range(NPEAKS):
-            InfIdx = np.argmax(x > (prevMu + prevDpp - 1.5 * DPPWIDTH))
-            SupIdx = np.argmax(x > (prevMu + prevDpp + 1.5 * DPPWIDTH))
-            xFit = x[InfIdx:SupIdx]
-            yFit = y[InfIdx:SupIdx]
-            muEstim = xFit[np.argmax(yFit)]
-
-            dataToFit = channeldata[np.abs(channeldata - muEstim) < 3 * DPPWIDTH]
-            sigmaEstim = np.std(dataToFit)
-
-            mu, sigma = norm.fit(dataToFit, loc=muEstim, scale=sigmaEstim)
-            prevMu = mu
-            aEstim = dataToFit.size / (2 * np.pi * sigma ** 2) ** 0.5
-            fits.append((aEstim, mu, sigma))
-
-            if GUI:
-                ax.plot(x, 2 * dataToFit.size * norm_pdf(x, mu, sigma), "b")
-                ax.vlines(dataToFit.min(), 0, y.max() * 1.3, ls=":", lw=0.8, color="b")
-                ax.vlines(dataToFit.max(), 0, y.max() * 1.3, ls=":", lw=0.8, color="b")
-
-        xInf = fits[0][1] - 1.5 * fits[0][2]
-        xSup = fits[-1][1] + 1.5 * fits[-1][2]
-
-        dataToFit = channeldata[(channeldata > xInf) & (channeldata < xSup)]
-
+BINS = np.arange(-50, 400, 2)
+
+# Fit status of each channel (saved in dppHgStatus.npy)
+STATUS_OK = 0
+STATUS_MISSING = 1  # no data or no pedestal
+STATUS_INVALID = 2  # Minuit did not converge to a valid minimum
+STATUS_FAILED = 3  # exception during the fit
+
+
+def fitChannel(channeldata, binned=False, dppEstim=DPPESTIM):
+    """Fit the first NPEAKS photoelectron peaks of a pedestal-subtracted channel.
+    The peaks are searched from dppEstim (e.g. the DPP of a previous run).
+    With binned=True the 3-Gaussian fit is an ExtendedBinnedNLL on the BINS histogram
+    instead of an ExtendedUnbinnedNLL on the events. Returns a dict with the DPP and
+    everything needed to draw the fit."""
+    y, x = np.histogram(channeldata, BINS)
+    x = (x[1:] + x[:-1]) * 0.5
+    prevMu = dppEstim
+    prevDpp = dppEstim
+
+    fits = []
+    peaks = []
+    for i in range(NPEAKS):
+        InfIdx = np.argmax(x > (prevMu + prevDpp - 1.5 * DPPWIDTH))
+        SupIdx = np.argmax(x > (prevMu + prevDpp + 1.5 * DPPWIDTH))
+        xFit = x[InfIdx:SupIdx]
+        yFit = y[InfIdx:SupIdx]
+        muEstim = xFit[np.argmax(yFit)]
+
+        dataToFit = channeldata[np.abs(channeldata - muEstim) < 3 * DPPWIDTH]
+        sigmaEstim = np.std(dataToFit)
+
+        mu, sigma = norm.fit(dataToFit, loc=muEstim, scale=sigmaEstim)
+        prevMu = mu
+        aEstim = dataToFit.size / (2 * np.pi * sigma ** 2) ** 0.5
+        fits.append((aEstim, mu, sigma))
+        peaks.append((dataToFit.size, mu, sigma, dataToFit.min(), dataToFit.max()))
+
+    xInf = fits[0][1] - 1.5 * fits[0][2]
+    xSup = fits[-1][1] + 1.5 * fits[-1][2]
+
+    dataToFit = channeldata[(channeldata > xInf) & (channeldata < xSup)]
+
+    if binned:
+        xe = BINS[(BINS >= xInf) & (BINS <= xSup)]
+        n, _ = np.histogram(dataToFit, xe)
+        cost3 = ExtendedBinnedNLL(n, xe, gauss3cdf)
+    else:
         cost3 = ExtendedUnbinnedNLL(dataToFit, gauss3)
-        fit3 = Minuit(cost3, (*fits[0], *fits[1], *fits[2]))
-        # A
-        fit3.limits[0] = (0, None)
-        fit3.limits[3] = (0, None)
-        fit3.limits[6] = (0, None)
-        # Mu
-        fit3.fixed[1] = True
-        fit3.fixed[4] = True
-        fit3.fixed[7] = True
-        # Sigma
-        fit3.limits[2] = (0.8 * fits[0][2], 1.2 * fits[0][2])
-        fit3.limits[5] = (0.8 * fits[1][2], 1.2 * fits[1][2])
-        fit3.limits[8] = (0.8 * fits[2][2], 1.2 * fits[2][2])
-        fit3.migrad()
-        fit3.fixed = False
-        fit3.limits[1] = (0.9 * fit3.values[1], 1.1 * fit3.values[1])
-        fit3.limits[4] = (0.9 * fit3.values[4], 1.1 * fit3.values[4])
-        fit3.limits[7] = (0.9 * fit3.values[7], 1.1 * fit3.values[7])
-        fit3.migrad()
-        dpp = (
-            (fit3.values[7] - fit3.values[4])
-            + (fit3.values[4] - fit3.values[1])
-            + (fit3.values[7] - fit3.values[1]) / 2
-        ) / 3
-
-        dpps[r, c] = dpp
-
-        if GUI:
-            ax.step(x, y, color="k", lw=2, label=(f"Channel of row {r} column {c}"))
-            ax.plot(x, 2 * gauss3(x, tuple(fit3.values))[1], "r")
-            ax.vlines(dataToFit.min(), 0, y.max() * 1.3, ls=":", lw=1, color="r")
-            ax.vlines(dataToFit.max(), 0, y.max() * 1.3, ls=":", lw=1, color="r")
-            mplhep.label._exp_label(ax=ax, data=True, exp="IDEA Dual-Readout", rlabel="SiPM Calibration")
-            ax.set_yscale("log")
-            ax.set_ylim(1, y.max() * 1.3)
-            ax.set_xlim(-50, 400)
-            plt.legend(
-                frameon=False,
-                title=f"$\mu_1 = {fit3.values[1]:.2f} +/- {fit3.errors[1]:.2f}$\n"
-                f"$\mu_2 = {fit3.values[4]:.2f} +/- {fit3.errors[4]:.2f}$\n"
-                f"$\mu_3 = {fit3.values[7]:.2f} +/- {fit3.errors[7]:.2f}$\n",
-            )
-            plt.draw()
-            plt.waitforbuttonpress()
-            ax.cla()
-        print(f"Channel {r} {c} has DPP {dpps[r][c]}")
-
-
-if "save" in sys.argv:
-    np.save("dppHg", dpps)
+    fit3 = Minuit(cost3, (*fits[0], *fits[1], *fits[2]))
+    # A
+    fit3.limits[0] = (0, None)
+    fit3.limits[3] = (0, None)
+    fit3.limits[6] = (0, None)
+    # Mu
+    fit3.fixed[1] = True
+    fit3.fixed[4] = True
+    fit3.fixed[7] = True
+    # Sigma
+    fit3.limits[2] = (0.8 * fits[0][2], 1.2 * fits[0][2])
+    fit3.limits[5] = (0.8 * fits[1][2], 1.2 * fits[1][2])
+    fit3.limits[8] = (0.8 * fits[2][2], 1.2 * fits[2][2])
+    fit3.migrad()
+    fit3.fixed = False
+    fit3.limits[1] = (0.9 * fit3.values[1], 1.1 * fit3.values[1])
+    fit3.limits[4] = (0.9 * fit3.values[4], 1.1 * fit3.values[4])
+    fit3.limits[7] = (0.9 * fit3.values[7], 1.1 * fit3.values[7])
+    fit3.migrad()
+    dpp = (
+        (fit3.values[7] - fit3.values[4])
+        + (fit3.values[4] - fit3.values[1])
+        + (fit3.values[7] - fit3.values[1]) / 2
+    ) / 3
+
+    return {
+        "dpp": dpp,
+        "status": STATUS_OK if fit3.valid else STATUS_INVALID,
+        "values": np.array(fit3.values),
+        "errors": np.array(fit3.errors),
+        "peaks": peaks,
+        "fitRange": (dataToFit.min(), dataToFit.max()),
+        "x": x,
+        "y": y,
+    }
+
+
+def fitTask(task):
+    """Fit one channel, isolating its failures from the other channels"""
+    r, c, rawdata, pedestal, binned, dppEstim = task
+    channeldata = rawdata[rawdata > 0] - pedestal
+    if np.isnan(pedestal) or channeldata.size == 0:
+        return r, c, {"dpp": np.nan, "status": STATUS_MISSING}
+    try:
+        return r, c, fitChannel(channeldata, binned, dppEstim)
+    except Exception as e:
+        return r, c, {"dpp": np.nan, "status": STATUS_FAILED, "error": repr(e)}
+
+
+def fitAll(counts, pedestals, binned=False, nWorkers=mp.cpu_count(), seeds=None, channels=None):
+    """Fit all channels from their (20, 16, NADC) ADC histograms, in parallel over nWorkers processes.
+    The ADC values of each channel are rebuilt from its histogram (same values, sorted).
+    seeds are per-channel DPP estimates (NaN or None: DPPESTIM); only the channels
+    selected by the channels mask are fitted, the others are left missing.
+    Returns the (20, 16) DPPs and status flags and the per-channel fit results."""
+    row, col, _ = counts.shape
+    dpps = np.full((row, col), np.nan)
+    status = np.full((row, col), STATUS_MISSING, dtype=np.uint8)
+    results = {}
+    seeds = np.full((row, col), DPPESTIM, dtype=np.float64) if seeds is None else np.where(np.isfinite(seeds), seeds, DPPESTIM)
+    channels = np.ones((row, col), dtype=bool) if channels is None else channels
+    tasks = (
+        (r, c, np.repeat(histograms.ADC, counts[r, c]), pedestals[r, c], binned, seeds[r, c])
+        for r, c in zip(*np.nonzero(channels))
+    )
+    if nWorkers > 1:
+        with mp.Pool(nWorkers) as pool:
+            done = list(tqdm(pool.imap_unordered(fitTask, tasks), total=channels.sum(), unit="channel", dynamic_ncols=True))
+    else:
+        done = map(fitTask, tasks)
+    for r, c, result in done:
+        dpps[r, c] = result["dpp"]
+        status[r, c] = result["status"]
+        results[r, c] = result
+    return dpps, status, results
+
+
+def drawChannel(ax, r, c, result):
+    x, y, values, errors = result["x"], result["y"], result["values"], result["errors"]
+    for n, mu, sigma, dataMin, dataMax in result["peaks"]:
+        ax.plot(x, 2 * n * norm_pdf(x, mu, sigma), "b")
+        ax.vlines(dataMin, 0, y.max() * 1.3, ls=":", lw=0.8, color="b")
+        ax.vlines(dataMax, 0, y.max() * 1.3, ls=":", lw=0.8, color="b")
+    ax.step(x, y, color="k", lw=2, label=(f"Channel of row {r} column {c}"))
+    ax.plot(x, 2 * gauss3(x, tuple(values))[1], "r")
+    ax.vlines(result["fitRange"][0], 0, y.max() * 1.3, ls=":", lw=1, color="r")
+    ax.vlines(result["fitRange"][1], 0, y.max() * 1.3, ls=":", lw=1, color="r")
+    mplhep.label._exp_label(ax=ax, data=True, exp="IDEA Dual-Readout", rlabel="SiPM Calibration")
+    ax.set_yscale("log")
+    ax.set_ylim(1, y.max() * 1.3)
+    ax.set_xlim(-50, 400)
+    ax.legend(
+        frameon=False,
+        title=f"$\mu_1 = {values[1]:.2f} +/- {errors[1]:.2f}$\n"
+        f"$\mu_2 = {values[4]:.2f} +/- {errors[4]:.2f}$\n"
+        f"$\mu_3 = {values[7]:.2f} +/- {errors[7]:.2f}$\n",
+    )
+
+
+def main(fname):
+    # Raw ntuple (converter histograms), histogram cache or aligned .npz/store
+    counts = histograms.load(fname, "hg")
+    pedestals = np.load("pedestalsHg.npy")
+    binned = "binned" in sys.argv
+    # Peaks searched from the DPPs of a previous run
+    seeds = np.load("dppHg.npy") if "warm" in sys.argv else None
+    nWorkers = 1 if GUI else mp.cpu_count()
+
+    if "compare" in sys.argv:
+        start = time()
+        dppUnbinned, statusUnbinned, _ = fitAll(counts, pedestals, False, nWorkers)
+        timeUnbinned = time() - start
+        start = time()
+        dppBinned, statusBinned, _ = fitAll(counts, pedestals, True, nWorkers)
+        timeBinned = time() - start
+        good = (statusUnbinned == STATUS_OK) & (statusBinned == STATUS_OK)
+        diff = dppBinned[good] - dppUnbinned[good]
+        print(f"Unbinned fits: {timeUnbinned:.1f} s, binned fits: {timeBinned:.1f} s ({nWorkers} workers)")
+        print(f"DPP binned - unbinned over {good.sum()} channels: mean {diff.mean():.4f} rms {diff.std():.4f} max {np.abs(diff).max():.4f}")
+        return
+
+    start = time()
+    dpps, status, results = fitAll(counts, pedestals, binned, nWorkers, seeds)
+    print(f"Fitted {dpps.size} channels in {time() - start:.1f} s")
+
+    if GUI:
+        fig, ax = plt.subplots()
+    for r in range(dpps.shape[0]):
+        if r % 4 == 0:
+            print()
+        for c in range(dpps.shape[1]):
+            if status[r, c] == STATUS_MISSING:
+                print(f"Missing channel {r} {c}")
+                continue
+            if status[r, c] == STATUS_FAILED:
+                print(f"Fit of channel {r} {c} failed: {results[r, c]['error']}")
+                continue
+            if GUI:
+                drawChannel(ax, r, c, results[r, c])
+                plt.draw()
+                plt.waitforbuttonpress()
+                ax.cla()
+            print(f"Channel {r} {c} has DPP {dpps[r][c]}" + ("" if status[r, c] == STATUS_OK else " (invalid fit)"))
+
+    if "book" in sys.argv:
+        start = time()
+        book = plotbook.render(
+            "dppHg",
+            drawChannel,
+            ((r, c, result) for (r, c), result in sorted(results.items()) if "values" in result),
+        )
+        if book is not None:
+            print(f"Plots saved in {book} in {time() - start:.1f} s")
+
+    if "save" in sys.argv:
+        np.save("dppHg", dpps)
+        np.save("dppHgStatus", status)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
@@ -0,0 +1,91 @@
+import sys
+import numpy as np
+from time import time
+import histograms
+
+# Part of the HG spectrum used: ADC 0 - WINDOW (pedestal and first photoelectron peaks)
+WINDOW = 512
+# Moving average subtracted to remove the envelope of the peaks (about half a DPP)
+SMOOTH = 13
+# Range of the first autocorrelation peak
+DPPMIN = 12
+DPPMAX = 45
+# Multiples of the DPP combined in the estimate
+NHARMONICS = 3
+# Half width of the search window around the multiples of the first peak
+HARMONICWIDTH = 3
+
+
+def autocorrelation(counts):
+    """Autocorrelation (lags 0 - WINDOW) of the HG spectrum of every channel after
+    subtracting its moving average, computed with one FFT over all channels.
+    Zeros (boards not triggered) are removed first."""
+    y = counts[..., :WINDOW].astype(np.float64)
+    y[..., 0] = 0
+    padded = np.pad(y, [(0, 0)] * (y.ndim - 1) + [(SMOOTH // 2, SMOOTH // 2)], mode="edge")
+    # Leading zero: cumulative[i + SMOOTH] - cumulative[i] is the sum of y[i - SMOOTH // 2 : i + SMOOTH // 2 + 1]
+    cumulative = np.concatenate([np.zeros(padded.shape[:-1] + (1,)), np.cumsum(padded, axis=-1)], axis=-1)
+    residual = y - (cumulative[..., SMOOTH:] - cumulative[..., :-SMOOTH])[..., :WINDOW] / SMOOTH
+    spectrum = np.fft.rfft(residual, n=2 * WINDOW)
+    return np.fft.irfft(np.abs(spectrum) ** 2)[..., :WINDOW]
+
+
+def peakLag(ac, lo, hi):
+    """Lag of the highest autocorrelation value in [lo, hi] of every channel, refined with a parabola"""
+    lags = np.arange(ac.shape[-1])
+    inRange = (lags >= lo[..., None]) & (lags <= hi[..., None])
+    i = np.clip(np.argmax(np.where(inRange, ac, -np.inf), axis=-1), 1, ac.shape[-1] - 2)[..., None]
+    left, center, right = (np.take_along_axis(ac, i + k, axis=-1)[..., 0] for k in (-1, 0, 1))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return i[..., 0] + 0.5 * (left - right) / (left - 2 * center + right)
+
+
+def fastDpp(counts):
+    """DPP of all channels from the peak spacing of their (20, 16, NADC) HG histograms.
+    The autocorrelation peaks at the first NHARMONICS multiples of the DPP are combined
+    with a straight-line fit through the origin. Missing channels are NaN.
+    The spacing does not depend on the pedestal, so the histograms are not shifted."""
+    ac = autocorrelation(counts)
+    first = peakLag(ac, np.full(counts.shape[:-1], DPPMIN), np.full(counts.shape[:-1], DPPMAX))
+    lags = [first]
+    for k in range(2, NHARMONICS + 1):
+        center = np.nan_to_num(np.round(k * first))
+        lags.append(peakLag(ac, center - HARMONICWIDTH, center + HARMONICWIDTH))
+    k = np.arange(1, NHARMONICS + 1)
+    dpp = sum(kk * lag for kk, lag in zip(k, lags)) / (k ** 2).sum()
+    dpp[ac[..., 0] == 0] = np.nan
+    return dpp
+
+
+def main(fname):
+    # Raw ntuple (converter histograms), histogram cache or aligned .npz/store
+    counts = histograms.load(fname, "hg")
+
+    start = time()
+    dpps = fastDpp(counts)
+    print(f"DPP of {dpps.size} channels in {1e3 * (time() - start):.1f} ms")
+
+    for r in range(dpps.shape[0]):
+        if r % 4 == 0:
+            print()
+        for c in range(dpps.shape[1]):
+            print(f"Channel {r} {c} has DPP {dpps[r, c]}")
+
+    if "compare" in sys.argv:
+        # Validation against the Minuit fits of dpp.py (dppHg.npy, dppHgStatus.npy)
+        import dpp  # only here: the fits need numba and iminuit
+
+        fitted = np.load("dppHg.npy")
+        good = np.load("dppHgStatus.npy") == dpp.STATUS_OK
+        good &= np.isfinite(dpps) & np.isfinite(fitted)
+        diff = dpps[good] - fitted[good]
+        print(
+            f"Fast - Minuit DPP over {good.sum()} channels: mean {diff.mean():.3f} rms {diff.std():.3f} max {np.abs(diff).max():.3f}"
+        )
+
+    if "save" in sys.argv:
+        np.save("dppHgFast", dpps)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
@@ -0,0 +1,131 @@
+import os
+import numpy as np
+import uproot
+from scipy.stats import chi2
+import alignedstore
+
+# ADC values go from 0 to 4096 (the converter clips at 4096)
+NADC = 4097
+ADC = np.arange(NADC)
+# Events histogrammed at once
+CHUNKSIZE = 1 << 14
+# Histogram cache of an aligned run: <run>_hist.npz with the "hg" and "lg" counts
+HIST_SUFFIX = "_hist.npz"
+# Names of the per-channel TH1I in the Histograms directory of a raw ntuple
+CONVERTER_NAMES = {"hg": "HighGainADC Board {}Channel {}", "lg": "LowGainADC Board {}Channel {}"}
+# and their titles: in spectroscopy + timing ntuples the ToT and ToA histograms of older
+# converters have the HighGainADC name too (as later cycles), only the title tells them apart
+CONVERTER_TITLES = {"hg": "HighGainADC", "lg": "LowGainADC"}
+
+
+def channelHistograms(matrix, chunkSize=CHUNKSIZE):
+    """Counts of every ADC value of all channels, shape (20, 16, NADC).
+    All channels of a chunk of events are filled with a single bincount over
+    the flattened (channel, ADC) index."""
+    row, col, evts = matrix.shape
+    offset = (np.arange(row * col) * NADC)[:, None]
+    counts = np.zeros(row * col * NADC, dtype=np.int64)
+    for start in range(0, evts, chunkSize):
+        block = np.asarray(matrix[:, :, start: start + chunkSize]).reshape(row * col, -1)
+        counts += np.bincount((np.minimum(block, NADC - 1) + offset).ravel(), minlength=counts.size)
+    return counts.reshape(row, col, NADC)
+
+
+def moments(counts, mask):
+    """Entries, mean and standard deviation of the ADC values selected by mask, for every channel"""
+    w = counts * mask
+    n = w.sum(axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = (w @ ADC) / n
+        sigma = np.sqrt(np.sum(w * (ADC - mean[..., None]) ** 2, axis=-1) / n)
+    return n, mean, sigma
+
+
+def truncatedGaussian(counts, mu, sigma, nSigma=3, nIter=1):
+    """Mean and standard deviation of the entries within nSigma of mu, for every channel.
+    With nIter > 1 the window is moved to the new mean and sigma and the estimate repeated."""
+    for _ in range(nIter):
+        n, mu, sigma = moments(counts, np.abs(ADC - mu[..., None]) < nSigma * sigma[..., None])
+    return n, mu, sigma
+
+
+def chi2Test(counts, reference, lo=1, hi=500):
+    """Two-sample chi2 test between the ADC histograms of every channel and a reference,
+    over the ADC values lo - hi and allowing for different numbers of entries.
+    Returns the p-values (NaN for channels empty in either histogram)."""
+    n1 = counts[..., lo:hi].astype(np.float64)
+    n2 = reference[..., lo:hi].astype(np.float64)
+    N1 = n1.sum(axis=-1)
+    N2 = n2.sum(axis=-1)
+    tot = n1 + n2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        terms = np.where(tot > 0, (N2[..., None] * n1 - N1[..., None] * n2) ** 2 / tot, 0)
+        chi2Value = terms.sum(axis=-1) / (N1 * N2)
+    ndf = (tot > 0).sum(axis=-1) - 1
+    pvalue = chi2.sf(chi2Value, np.maximum(ndf, 1))
+    pvalue[(N1 == 0) | (N2 == 0)] = np.nan
+    return pvalue
+
+
+def withTitle(directory, keys, title):
+    """First of the histograms keys of directory with title (ROOT keeps the axis titles after ";"), or None"""
+    for key in keys:
+        histo = directory[key]
+        if histo.title.split(";")[0] == title:
+            return histo
+    return None
+
+
+def fromConverter(fname, key="hg"):
+    """Counts of "hg" or "lg", shape (20, 16, NADC), from the per-channel TH1I written by the
+    converter in a raw ntuple. The TH1I have 4096 bins from 0 to 4095, so bin i holds ADC i
+    for i < 4095; ADC 4095 and above fall in the overflow and are put in ADC 4095.
+    Boards missing from the file are left empty. Of the histograms with the same name, the one
+    with the ADC title is used."""
+    counts = np.zeros((20, 16, NADC), dtype=np.int64)
+    # Board b fills rows 4b - 4b+3 (same as the aligned matrices)
+    boards = counts.reshape(-1, 64, NADC)
+    with uproot.open(fname) as f:
+        histos = f["Histograms"]
+        cycles = {}
+        for name in sorted(histos.keys(cycle=True), key=lambda k: int(k.rsplit(";", 1)[1])):
+            cycles.setdefault(name.rsplit(";", 1)[0], []).append(name)
+        for b in range(boards.shape[0]):
+            for j in range(64):
+                name = CONVERTER_NAMES[key].format(b, j)
+                histo = withTitle(histos, cycles.get(name, []), CONVERTER_TITLES[key])
+                if histo is None:
+                    continue
+                values = histo.values(flow=True)
+                boards[b, j, :4095] = values[1:4096]
+                boards[b, j, 4095] = values[4096:].sum()
+    return counts
+
+
+def cacheName(fname):
+    base = fname.rstrip("/")
+    for suffix in (".npz", alignedstore.STORE_SUFFIX, ".root"):
+        if base.endswith(suffix):
+            base = base[: -len(suffix)]
+            break
+    return base + HIST_SUFFIX
+
+
+def load(fname, key="hg"):
+    """Counts of "hg" or "lg", shape (20, 16, NADC), from
+    - a raw ntuple (.root): the histograms filled by the converter;
+    - a histogram cache (_hist.npz);
+    - an aligned .npz or store: histogrammed once, then read from the <run>_hist.npz cache.
+    Only the kilobytes of the histograms are read, except when the cache is created."""
+    if fname.endswith(".root"):
+        return fromConverter(fname, key)
+    if fname.endswith(HIST_SUFFIX):
+        with np.load(fname) as f:
+            return f[key]
+    cache = cacheName(fname)
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(fname):
+        with np.load(cache) as f:
+            return f[key]
+    counts = {k: channelHistograms(alignedstore.load(fname, k)) for k in ("hg", "lg")}
+    np.savez_compressed(cache, **counts)
+    return counts[key]
@@ -1,11 +1,11 @@
 import numpy as np
 import matplotlib.pyplot as plt
-import sys, mplhep
+import sys, mplhep, resource
 import numba as nb
-from iminuit import Minuit
-from iminuit.cost import LeastSquares
-from iminuit.util import propagate
-from functools import partial
+from time import time
+import alignedstore
+import histograms
+import plotbook
 
 plt.style.use(mplhep.style.ATLAS)
 
@@ -21,69 +21,132 @@ if "plot" in sys.argv:
 
 INF = 10
 SUP = 130
+# Events drawn per channel (every n-th event, the fit uses all of them)
+MAXPOINTS = 20000
+
+
+def lineSums(matrixHg, matrixLg, pedestalHg, dppHg, chunkSize=histograms.CHUNKSIZE):
+    """Sums S0, Sx, Sxx, Sy, Sxy of the (HG pe, LG ADC) points with INF < HG pe < SUP,
+    for all channels in a single pass over blocks of events. Returns a (5, 20, 16) array."""
+    row, col, evts = matrixHg.shape
+    sums = np.zeros((5, row, col))
+    pedestal = pedestalHg[..., None]
+    dpp = dppHg[..., None]
+    for start in range(0, evts, chunkSize):
+        hg = np.asarray(matrixHg[:, :, start: start + chunkSize])
+        x = (hg - pedestal) / dpp
+        # Zeros are boards not triggered
+        w = (hg != 0) & (x > INF) & (x < SUP)
+        x = np.where(w, x, 0.)
+        y = np.where(w, matrixLg[:, :, start: start + chunkSize], 0.)
+        sums[0] += w.sum(axis=-1)
+        sums[1] += x.sum(axis=-1)
+        sums[2] += np.einsum("ijk,ijk->ij", x, x)
+        sums[3] += y.sum(axis=-1)
+        sums[4] += np.einsum("ijk,ijk->ij", x, y)
+    return sums
+
+
+def lineFit(sums):
+    """Least-squares line y = m x + q (unit errors) of every channel from its sums.
+    Returns m, q and their (20, 16, 2, 2) covariance (X^T X)^-1, as given by HESSE."""
+    s0, sx, sxx, sy, sxy = sums
+    with np.errstate(invalid="ignore", divide="ignore"):
+        det = s0 * sxx - sx ** 2
+        m = (s0 * sxy - sx * sy) / det
+        q = (sxx * sy - sx * sxy) / det
+        cov = np.stack([np.stack([s0, -sx], axis=-1), np.stack([-sx, sxx], axis=-1)], axis=-2) / det[..., None, None]
+    return m, q, cov
+
+
+def drawChannel(ax, r, c, item):
+    channelHg, channelLgADC, pedestal, dpp, values, cov = item
+    channelHgPe = (np.float64(channelHg) - pedestal) / dpp
+    channelHgPe[channelHg == 0] = 0
+    x = channelHgPe[(channelHgPe > INF) & (channelHgPe < SUP)]
+    y = channelLgADC[(channelHgPe > INF) & (channelHgPe < SUP)]
+    errors = np.sqrt(np.diag(cov))
+
+    xFit = np.arange(channelHgPe.min(), channelHgPe.max(), 0.1)
+    yFit = line(xFit, *values)
+    # Band of 100 bootstrapped lines, evaluated all at once
+    par_b = np.random.multivariate_normal(values, cov, size=100)
+    yFitErr = np.std(par_b[:, :1] * xFit + par_b[:, 1:], axis=0)
+    ax.plot(channelHgPe, channelLgADC, ".", ms=1, c="k", label="Data")
+    ax.plot(x, y, ".", ms=1.7, c="b", label="Data fitted")
+    ax.plot(xFit, yFit, "r")
+    ax.fill_between(xFit, yFit - 5 * yFitErr, yFit + 5 * yFitErr, facecolor="r", alpha=0.5)
+    ax.set_xlim(-10, 175)
+    ax.set_ylim(10, 1.3 * yFit.max())
+    mplhep.label._exp_label(ax=ax, data=True, exp="IDEA Dual-Readout", rlabel="SiPM Calibration")
+    # A fixed location: "best" scans all the points
+    ax.legend(
+        frameon=False,
+        loc="upper left",
+        title=f"$DPP_{{lg}} = {values[0]:.2f} +/- {errors[0]:.2f} ADC/pe$\n"
+        f"$Pedestal_{{lg}} = {values[1]:.2f} +/- {errors[1]:.2f} ADC$\n",
+    )
+
+
+def main(fname):
+    # Aligned .npz archive or aligned store (memory-mapped, read one block of events at a time)
+    matrixHg = alignedstore.load(fname, "hg")
+    matrixLg = alignedstore.load(fname, "lg")
+
+    pedestalHg = np.load("pedestalsHg.npy")
+    dppHg = np.load("dppHg.npy")
+
+    start = time()
+    dppLg, pedestalLg, cov = lineFit(lineSums(matrixHg, matrixLg, pedestalHg, dppHg))
+    errors = np.sqrt(np.diagonal(cov, axis1=-2, axis2=-1))
+    print(f"Fitted {dppLg.size} channels in {time() - start:.1f} s")
+
+    def channelItem(r, c):
+        values = (dppLg[r, c], pedestalLg[r, c])
+        step = max(1, matrixHg.shape[-1] // MAXPOINTS)
+        return r, c, (
+            np.asarray(matrixHg[r, c, ::step]),
+            np.asarray(matrixLg[r, c, ::step]),
+            pedestalHg[r, c],
+            dppHg[r, c],
+            values,
+            cov[r, c],
+        )
 
-fname = sys.argv[1]
-
-with np.load(fname) as f:
-    matrixHg = np.float32(f["hg"])
-    matrixLg = np.float32(f["lg"])
-
-pedestalHg = np.load("pedestalsHg.npy")
-dppHg = np.load("dppHg.npy")
-
-matrixHg[matrixHg == 0] = np.inf
-matrixHg = (matrixHg - pedestalHg[:, :, None]) / dppHg[:, :, None]
-matrixHg[matrixHg == np.inf] = 0
-
-row, col, evt = matrixHg.shape
-
-dppLg = np.zeros_like(dppHg)
-pedestalLg = np.zeros_like(pedestalHg)
-if GUI:
-    fig, ax = plt.subplots()
-
-for r in range(row):
-    for c in range(col):
+    row, col, _ = matrixHg.shape
+    if GUI:
+        fig, ax = plt.subplots()
 
-        channelHgPe = matrixHg[r, c, :]
-        channelLgADC = matrixLg[r, c, :]
+    for r in range(row):
+        for c in range(col):
+            values = (dppLg[r, c], pedestalLg[r, c])
+            print(
+                f"Channel {r} - {c} ADC/pe: {values[0]:.2f} +/- {errors[r, c, 0]:.2f} Pedestal: {values[1]:.2f} +/- {errors[r, c, 1]:.2f}"
+            )
 
-        x = channelHgPe[(channelHgPe > INF) & (channelHgPe < SUP)]
-        y = channelLgADC[(channelHgPe > INF) & (channelHgPe < SUP)]
+            if GUI:
+                drawChannel(ax, *channelItem(r, c))
+                plt.draw()
+                plt.waitforbuttonpress()
+                ax.cla()
+
+    if "book" in sys.argv:
+        start = time()
+        book = plotbook.render(
+            "lgCalibration",
+            drawChannel,
+            (channelItem(r, c) for r in range(row) for c in range(col) if np.isfinite(dppLg[r, c])),
+        )
+        if book is not None:
+            print(f"Plots saved in {book} in {time() - start:.1f} s")
 
-        lsq = LeastSquares(x, y, np.ones_like(y), line)
-        fit = Minuit(lsq, m=1, q=60)
-        fit.migrad()
-        fit.hesse()
-        dppLg[r, c] = fit.values["m"]
-        pedestalLg[r, c] = fit.values["q"]
+    # ru_maxrss is in kB on Linux
+    print(f"Peak memory: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
 
-        print(
-            f"Channel {r} - {c} ADC/pe: {fit.values[0]:.2f} +/- {fit.errors[0]:.2f} Pedestal: {fit.values[1]:.2f} +/- {fit.errors[1]:.2f}"
-        )
+    if "save" in sys.argv:
+        np.save("pedestalsLg", pedestalLg)
+        np.save("dppLg", dppLg)
 
-        if GUI:
-            xFit = np.arange(channelHgPe.min(), channelHgPe.max(), 0.1)
-            yFit = line(xFit, *fit.values)
-            par_b = np.random.multivariate_normal(fit.values, fit.covariance, size=100)
-            y_b = [line(xFit, *p) for p in par_b]
-            yFitErr = np.std(y_b, axis=0)
-            ax.scatter(channelHgPe, channelLgADC, s=1, c="k", label="Data")
-            ax.scatter(x, y, s=3, c="b", label="Data fitted")
-            ax.plot(xFit, yFit, "r")
-            ax.fill_between(xFit, yFit - 5 * yFitErr, yFit + 5 * yFitErr, facecolor="r", alpha=0.5)
-            ax.set_xlim(-10, 175)
-            ax.set_ylim(10, 1.3 * yFit.max())
-            mplhep.label._exp_label(ax=ax, data=True, exp="IDEA Dual-Readout", rlabel="SiPM Calibration")
-            plt.legend(
-                frameon=False,
-                title=f"$DPP_{{lg}} = {fit.values[0]:.2f} +/- {fit.errors[0]:.2f} ADC/pe$\n"
-                f"$Pedestal_{{lg}} = {fit.values[1]:.2f} +/- {fit.errors[1]:.2f} ADC$\n",
-            )
-            plt.draw()
-            plt.waitforbuttonpress()
-            ax.cla()
 
-if "save" in sys.argv:
-    np.save("pedestalsLg", pedestalLg)
-    np.save("dppLg", dppLg)
+if __name__ == "__main__":
+    main(sys.argv[1])
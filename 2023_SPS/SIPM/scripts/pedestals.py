@@ -3,7 +3,9 @@ from matplotlib import pyplot as plt
 import numba as nb
 import sys, mplhep
 from numba_stats import norm_pdf
-from scipy.stats import norm
+from time import time
+import histograms
+import plotbook
 
 plt.style.use(mplhep.style.ATLAS)
 
@@ -12,60 +14,109 @@ GUI = False
 if "plot" in sys.argv:
     GUI = True
 
+# Half width of the window around a previous pedestal used to seed the sigma
+PEDWINDOW = 40
+
 
 @nb.njit(fastmath=True)
 def gauss(x, par):
     return par[0], par[0] * norm_pdf(x, par[1], par[2])
 
 
-with np.load(sys.argv[1]) as f:
-    data = np.float32(f["hg"])
-
-row, col, evts = data.shape
-pedestals = np.empty((20, 16))
-
-if GUI:
-    fig, ax = plt.subplots()
-
-for r in range(row):
-    if r % 4 == 0:
-        print()
-    for c in range(col):
-        channeldata = data[r, c, :]
-        channeldata = channeldata[channeldata > 0]
-        if np.any((channeldata > 0) & (channeldata < 500)) == False:
-            print(f"Missing channel {r}-{c}")
-            continue
-        y, x = np.histogram(channeldata, np.arange(1, 500))
-        x = (x[1:] + x[:-1]) * 0.5
-
-        aEstim = y.max()
-        muEstim = x[np.argmax(y)]
-        sigmaEstim = np.std(channeldata[channeldata < 80])
-
-        dataToFit = channeldata[np.abs(channeldata - muEstim) < 3 * sigmaEstim]
-        sigmaEstim = np.std(dataToFit)
-
-        fit = norm.fit(dataToFit, loc=muEstim, scale=sigmaEstim)
-
-        mu, sigma = fit
-        pedestals[r, c] = mu
-
-        print(f"Pedestal of fiber {r}-{c} = {mu}")
-        if GUI:
-            ax.step(x, y, color="k", label=(f"Channel in row {r} column {c}"))
-            ax.plot(x, dataToFit.size * norm_pdf(x, mu, sigma), "r")
-            mplhep.label._exp_label(ax=ax, data=True, exp="IDEA Dual-Readout", rlabel="SiPM Calibration")
-            ax.set_xlim(-100, 500)
-            ax.set_yscale("log")
-            ax.set_ylim(1, y.max() * 1.3)
-            plt.legend(
-                frameon=False,
-                title=f"$\mu = {mu:.2f}$\n" f"$\sigma = {sigma:.2f}$",
-            )
-            plt.draw()
-            plt.waitforbuttonpress()
-            ax.cla()
-
-if "save" in sys.argv:
-    np.save("pedestalsHg", pedestals)
+def estimatePedestals(counts, previous=None):
+    """Pedestal of all channels at once from their (20, 16, NADC) ADC histograms.
+    Per channel: peak of the 1-500 ADC histogram, sigma of the entries below 80 ADC,
+    then mean and sigma of the entries within 3 sigma of the peak (the Gaussian MLE).
+    With the pedestals of a previous run, channels are seeded from them instead
+    (sigma of the entries within PEDWINDOW).
+    Returns mu, sigma, entries used and the mask of missing channels."""
+    counts = counts.copy()
+    # Zeros are boards not triggered
+    counts[..., 0] = 0
+
+    # Same bins as np.histogram(channeldata, np.arange(1, 500)): the last bin includes 499
+    y = counts[..., 1:499].copy()
+    y[..., -1] += counts[..., 499]
+    x = np.arange(1, 499) + 0.5
+    missing = counts[..., 1:500].sum(axis=-1) == 0
+
+    muEstim = x[np.argmax(y, axis=-1)]
+    _, _, sigmaEstim = histograms.moments(counts, histograms.ADC < 80)
+    if previous is not None:
+        seeded = np.isfinite(previous)
+        seed = np.where(seeded, previous, 0)
+        _, _, sigmaSeed = histograms.moments(counts, np.abs(histograms.ADC - seed[..., None]) < PEDWINDOW)
+        muEstim = np.where(seeded, seed, muEstim)
+        sigmaEstim = np.where(seeded, sigmaSeed, sigmaEstim)
+
+    n, mu, sigma = histograms.truncatedGaussian(counts, muEstim, sigmaEstim, 3)
+    mu[missing] = np.nan
+    sigma[missing] = np.nan
+    return mu, sigma, n, missing
+
+
+def drawChannel(ax, r, c, item):
+    channelCounts, entries, mu, sigma = item
+    y = channelCounts[1:499].copy()
+    y[-1] += channelCounts[499]
+    x = np.arange(1, 499) + 0.5
+    ax.step(x, y, color="k", label=(f"Channel in row {r} column {c}"))
+    ax.plot(x, entries * norm_pdf(x, mu, sigma), "r")
+    mplhep.label._exp_label(ax=ax, data=True, exp="IDEA Dual-Readout", rlabel="SiPM Calibration")
+    ax.set_xlim(-100, 500)
+    ax.set_yscale("log")
+    ax.set_ylim(1, y.max() * 1.3)
+    ax.legend(
+        frameon=False,
+        title=f"$\mu = {mu:.2f}$\n" f"$\sigma = {sigma:.2f}$",
+    )
+
+
+def main(fname):
+    # Raw ntuple (converter histograms), histogram cache or aligned .npz/store
+    counts = histograms.load(fname, "hg")
+
+    # Seeded from the pedestals of a previous run
+    previous = np.load("pedestalsHg.npy") if "warm" in sys.argv else None
+    pedestals, sigmas, entries, missing = estimatePedestals(counts, previous)
+
+    row, col, _ = counts.shape
+    if GUI:
+        fig, ax = plt.subplots()
+
+    for r in range(row):
+        if r % 4 == 0:
+            print()
+        for c in range(col):
+            if missing[r, c]:
+                print(f"Missing channel {r}-{c}")
+                continue
+            mu, sigma = pedestals[r, c], sigmas[r, c]
+            print(f"Pedestal of fiber {r}-{c} = {mu}")
+            if GUI:
+                drawChannel(ax, r, c, (counts[r, c], entries[r, c], mu, sigma))
+                plt.draw()
+                plt.waitforbuttonpress()
+                ax.cla()
+
+    if "book" in sys.argv:
+        start = time()
+        book = plotbook.render(
+            "pedestalsHg",
+            drawChannel,
+            (
+                (r, c, (counts[r, c], entries[r, c], pedestals[r, c], sigmas[r, c]))
+                for r in range(row)
+                for c in range(col)
+                if not missing[r, c]
+            ),
+        )
+        if book is not None:
+            print(f"Plots saved in {book} in {time() - start:.1f} s")
+
+    if "save" in sys.argv:
+        np.save("pedestalsHg", pedestals)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
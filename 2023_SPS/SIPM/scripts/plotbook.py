@@ -0,0 +1,58 @@
+import os
+import multiprocessing as mp
+from functools import partial
+from matplotlib.figure import Figure
+from PIL import Image
+from tqdm import tqdm
+
+# One page per row of the SiPM matrix: its 16 channels on a 4 x 4 grid
+GRID = (4, 4)
+FIGSIZE = (24, 20)
+DPI = 60
+
+
+def renderPage(draw, outdir, page):
+    """Draw the channels of one matrix row and save the page as a PNG thumbnail grid.
+    Uses a bare Figure (no pyplot), so it runs headless in the worker processes."""
+    r, items = page
+    fig = Figure(figsize=FIGSIZE)
+    axes = fig.subplots(*GRID).ravel()
+    drawn = set()
+    for row, col, item in items:
+        draw(axes[col], row, col, item)
+        drawn.add(col)
+    for col in set(range(axes.size)) - drawn:
+        axes[col].set_axis_off()
+        axes[col].set_title(f"Channel {r} {col} not available")
+    # Fixed margins: tight_layout would draw the page twice
+    fig.subplots_adjust(left=0.04, right=0.99, bottom=0.04, top=0.97, wspace=0.2, hspace=0.25)
+    png = os.path.join(outdir, f"row{r:02d}.png")
+    fig.savefig(png, dpi=DPI)
+    return png
+
+
+def render(name, draw, items, nWorkers=mp.cpu_count()):
+    """Render draw(ax, r, c, item) for all the (r, c, item) in items, one page per matrix row,
+    in parallel over nWorkers processes. draw must be a module-level function.
+    The pages are saved in <name>_pages/ and collected in <name>.pdf, which is returned
+    (None if there is nothing to draw)."""
+    pages = {}
+    for r, c, item in items:
+        pages.setdefault(r, []).append((r, c, item))
+    if not pages:
+        print(f"No channels to plot in {name}")
+        return None
+    outdir = name + "_pages"
+    os.makedirs(outdir, exist_ok=True)
+    with mp.Pool(nWorkers) as pool:
+        pngs = list(
+            tqdm(
+                pool.imap(partial(renderPage, draw, outdir), sorted(pages.items())),
+                total=len(pages),
+                unit="page",
+                dynamic_ncols=True,
+            )
+        )
+    images = [Image.open(png).convert("RGB") for png in pngs]
+    images[0].save(name + ".pdf", save_all=True, append_images=images[1:])
+    return name + ".pdf"
@@ -0,0 +1,46 @@
+import os
+import numpy as np
+import uproot
+import align
+
+NTRIGGERS = 10
+
+
+def writeRaw(fname, tid, bid):
+    """SiPMData tree of the raw ntuples: every channel of a fragment holds its index in the file"""
+    adc = np.repeat(np.arange(tid.size, dtype=np.uint16)[:, None], 64, axis=1)
+    with uproot.recreate(fname) as f:
+        f["SiPMData"] = {"TriggerId": tid, "BoardId": bid, "HighGainADC": adc, "LowGainADC": adc + 1}
+
+
+def fragments():
+    """6 fragments per trigger: the even triggers repeat board 0 as 6th fragment (dropped by the
+    MAXBOARDS cut), the odd ones as 3rd fragment (kept instead of the first, board 4 is lost)"""
+    tid, bid = [], []
+    for trigger in range(1, NTRIGGERS + 1):
+        boards = [0, 1, 2, 3, 4, 0] if trigger % 2 == 0 else [0, 1, 0, 2, 3, 4]
+        tid += [trigger] * len(boards)
+        bid += boards
+    return np.array(tid, dtype=np.uint64), np.array(bid, dtype=np.uint8)
+
+
+def test_stream_matches_alignFragments(tmp_path):
+    tid, bid = fragments()
+    for mode in ["memory", "stream"]:
+        os.makedirs(tmp_path / mode)
+        writeRaw(str(tmp_path / mode / "Run1_list.root"), tid, bid)
+    align.runAlignement(str(tmp_path / "memory" / "Run1_list.root"))
+    align.streamAlignement(str(tmp_path / "stream" / "Run1_list.root"), stepSize=7)
+
+    with np.load(tmp_path / "memory" / "Run1_list.npz") as memory, np.load(tmp_path / "stream" / "Run1_list.npz") as stream:
+        for key in ["hg", "lg", "tid"]:
+            np.testing.assert_array_equal(memory[key], stream[key])
+        hg = memory["hg"].reshape(align.MAXBOARDS, 64, NTRIGGERS)
+
+    for event in range(NTRIGGERS):
+        first = 6 * event
+        if (event + 1) % 2 == 0:
+            expected = [first, first + 1, first + 2, first + 3, first + 4]
+        else:
+            expected = [first + 2, first + 1, first + 3, first + 4, 0]
+        np.testing.assert_array_equal(hg[:, 0, event], expected)
@@ -0,0 +1,46 @@
+import numpy as np
+import uproot
+import histograms
+
+
+def th1i(title, values):
+    """TH1I of the converter (4096 bins from 0 to 4095) with the given bin contents (flow bins included)"""
+    return uproot.writing.identify.to_TH1x(
+        fName=None,
+        fTitle=title,
+        data=values.astype(np.int32),
+        fEntries=values.sum(),
+        fTsumw=values.sum(),
+        fTsumw2=values.sum(),
+        fTsumwx=0,
+        fTsumwx2=0,
+        fSumw2=values.astype(np.float64),
+        fXaxis=uproot.writing.identify.to_TAxis("xaxis", "ADC", 4096, 0, 4095),
+    )
+
+
+def spectrum(peak):
+    values = np.zeros(4098)
+    values[peak + 1] = 10
+    return values
+
+
+def test_timing_ntuple(tmp_path):
+    """Spectroscopy + timing ntuple of older converters: the ToT and ToA histograms are written
+    after the HG one with its name (later cycles)"""
+    fname = str(tmp_path / "Run1_list.root")
+    with uproot.recreate(fname) as f:
+        for j in range(64):
+            f[f"Histograms/LowGainADC Board 0Channel {j}"] = th1i("LowGainADC", spectrum(j + 1))
+            name = f"Histograms/HighGainADC Board 0Channel {j}"
+            f[name] = th1i("HighGainADC", spectrum(j + 100))
+            f[name] = th1i("TotTDC", spectrum(3000))
+            f[name] = th1i("ToaTDC", spectrum(4000))
+
+    for key, first in [("hg", 100), ("lg", 1)]:
+        counts = histograms.fromConverter(fname, key).reshape(-1, 64, histograms.NADC)
+        for j in range(64):
+            expected = np.zeros(histograms.NADC)
+            expected[j + first] = 10
+            np.testing.assert_array_equal(counts[0, j], expected)
+        assert counts[1:].sum() == 0
@@ -0,0 +1,192 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import DRSiPMEvent
+
+# Event header: same for spectroscopy and spectroscopy + timing (27 bytes)
+HEADER_DTYPE = [
+  ("EventSize", "<u2"),
+  ("BoardID", "u1"),
+  ("TriggerTimeStamp", "<f8"),
+  ("TriggerID", "<u8"),
+  ("ChannelMask", "<u8"),
+]
+
+# Channel data of acqMode 0 (spectroscopy) and 1 (spectroscopy + timing, as in the converter)
+CHANNEL_DTYPE = [
+  [("channelID", "u1"), ("dataType", "u1"), ("lgPha", "<u2"), ("hgPha", "<u2")],
+  [("channelID", "u1"), ("dataType", "u1"), ("lgPha", "<u2"), ("hgPha", "<u2"), ("toa", "<u4"), ("tot", "<u2")],
+]
+
+# Acquisition mode in the file header (byte 5) -> acqMode of DRdecode
+FILE_ACQ_MODE = {1: 0, 3: 1}
+
+# Events checked at a time by the record scan
+BLOCK_SIZE = 1 << 20
+# Bytes searched at a time for the next event in recovery mode
+RESYNC_WINDOW = 1 << 22
+# Largest board ID accepted (as MAX_BOARD_ID of the converter)
+MAX_BOARD_ID = 15
+# Trigger IDs accepted around the last good one when resynchronising, plus one per event header
+# that fits in the skipped bytes (as RESYNC_TRIGGER_WINDOW of the converter)
+RESYNC_TRIGGER_WINDOW = 1000
+# Bytes decompressed at a time from archived raw files
+DECOMPRESS_CHUNK = 1 << 20
+
+LUT = np.array(DRSiPMEvent.MAPPING_LUT)
+# Channel read out at each calorimeter position
+INVERSE_LUT = np.argsort(LUT)
+
+
+def recordDtype(acqMode):
+  """Structured dtype of a whole event (header + 64 channels)"""
+  return np.dtype(HEADER_DTYPE + [("channels", CHANNEL_DTYPE[acqMode], DRSiPMEvent.NCHANNELS)])
+
+
+def mapRaw(fname):
+  """Raw file as a memory-mapped uint8 array. Archived files (.bz2, .zst) are first fully decompressed,
+     DECOMPRESS_CHUNK bytes at a time, into an anonymous temporary file next to them (needs as much free
+     disk as the raw file), so the data sit on disk and in the page cache instead of the process memory"""
+  if any(fname.endswith(suffix) for suffix in DRSiPMEvent.COMPRESSED_SUFFIXES):
+    with DRSiPMEvent.openRaw(fname) as infile, tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(fname))) as tmp:
+      shutil.copyfileobj(infile, tmp, DECOMPRESS_CHUNK)
+      tmp.flush()
+      # the map keeps the data after the file is closed (and deleted)
+      return np.memmap(tmp, dtype=np.uint8, mode="r")
+  return np.memmap(fname, dtype=np.uint8, mode="r")
+
+
+def validRows(rows):
+  """Which rows (events as (n, size) bytes) are a full event: their size, a board ID up to MAX_BOARD_ID,
+     all the channels in the mask and channel IDs that can be mapped"""
+  size = rows.shape[1]
+  header = DRSiPMEvent.EVENT_HEADER_SIZE[0]
+  ok = (rows[:, 0] == size & 0xFF) & (rows[:, 1] == size >> 8) & (rows[:, 2] <= MAX_BOARD_ID)
+  ok &= (rows[:, 19:27] == 0xFF).all(axis=1)
+  ok &= (rows[:, header :: (size - header) // DRSiPMEvent.NCHANNELS] < DRSiPMEvent.NCHANNELS).all(axis=1)
+  return ok
+
+
+def validStarts(raw, starts, size):
+  """Candidate starts holding a full event (see validRows)"""
+  starts = starts[starts + size <= raw.size]
+  return starts[validRows(raw[starts[:, None] + np.arange(size)])]
+
+
+def findNextEvent(raw, pos, size, lastTriggerId=None):
+  """First byte from pos on where a full event starts, with a TriggerID close to lastTriggerId (if any good
+     event was found before) and followed by another full event (or the end of the file).
+     Candidates are the bytes matching the event size, searched RESYNC_WINDOW bytes at a time"""
+  start = pos
+  while pos + size <= raw.size:
+    stop = min(pos + RESYNC_WINDOW, raw.size - size + 1)
+    window = raw[pos : stop + 1]
+    candidates = validStarts(raw, pos + np.flatnonzero((window[:-1] == size & 0xFF) & (window[1:] == size >> 8)), size)
+    if lastTriggerId is not None:
+      triggers = raw[candidates[:, None] + 11 + np.arange(8)].view("<u8")[:, 0]
+      # every lost event may have been a new trigger
+      maxJump = (RESYNC_TRIGGER_WINDOW + (candidates - start) // DRSiPMEvent.EVENT_HEADER_SIZE[0]).astype(np.uint64)
+      close = (triggers >= np.uint64(max(lastTriggerId - RESYNC_TRIGGER_WINDOW, 0))) & (triggers <= np.uint64(lastTriggerId) + maxJump)
+      candidates = candidates[close]
+    followed = np.isin(candidates + size, validStarts(raw, candidates + size, size)) | (candidates + size == raw.size)
+    if followed.any():
+      return int(candidates[followed][0])
+    pos = stop
+  return raw.size
+
+
+def recordStarts(raw, size, start=DRSiPMEvent.FILE_HEADER_SIZE, recover=False):
+  """Start byte of every event of the expected size, following the EventSize chain.
+     Events are checked BLOCK_SIZE at a time assuming they all have the expected size;
+     after a wrong one the chain is followed from its EventSize and the scan goes on.
+     With recover the scan goes on from the next valid event instead (see findNextEvent).
+     Returns the starts and the skipped (first byte, start of the next event) ranges"""
+  starts = []
+  skipped = []
+  lastTriggerId = None
+  pos = start
+  while pos + size <= raw.size:
+    offsets = pos + size * np.arange(min(BLOCK_SIZE, (raw.size - pos) // size), dtype=np.int64)
+    sizes = raw[offsets].astype(np.uint16) | raw[offsets + 1].astype(np.uint16) << 8
+    if recover:
+      # garbage can also have the right size
+      wrong = np.flatnonzero(~validRows(raw[pos : pos + offsets.size * size].reshape(-1, size)))
+    else:
+      wrong = np.flatnonzero(sizes != size)
+    good = wrong[0] if wrong.size else offsets.size
+    starts.append(offsets[:good])
+    if good > 0:
+      lastTriggerId = int(raw[offsets[good - 1] + 11 : offsets[good - 1] + 19].view("<u8")[0])
+    pos += good * size
+    if wrong.size:
+      if recover:
+        nextStart = findNextEvent(raw, pos + 1, size, lastTriggerId)
+        skipped.append((int(pos), nextStart))
+        pos = nextStart
+      elif sizes[good] == 0:
+        raise ValueError(f"Event size is 0 at byte {pos}")
+      else:
+        # skip the wrong event
+        pos += int(sizes[good])
+  return (np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64)), skipped
+
+
+def decodeRecords(records, acqMode):
+  """Arrays of the events in records (structured view of consecutive events, see decodeFile)"""
+  # Size as given by the channel mask (events of the right size but fewer channels are skipped)
+  masks = records["ChannelMask"].astype("<u8").view(np.uint8).reshape(-1, 8)
+  active = np.unpackbits(masks, axis=1).sum(axis=1)
+  expected = DRSiPMEvent.EVENT_HEADER_SIZE[acqMode] + active * np.dtype(CHANNEL_DTYPE[acqMode]).itemsize
+  ok = records["EventSize"] == expected
+  if not ok.all():
+    records = records[ok]
+
+  channels = records["channels"]
+  channelID = np.ascontiguousarray(channels["channelID"])
+  # Map channel to position in calo: the channels are always read out in order
+  # (one gather of the columns), else each event has its own mapping
+  inOrder = (channelID == np.arange(DRSiPMEvent.NCHANNELS)).all()
+  events = {
+    "BoardID": records["BoardID"].copy(),
+    "TriggerTimeStamp": records["TriggerTimeStamp"].copy(),
+    "TriggerID": records["TriggerID"].copy(),
+  }
+  for name in ["lgPha", "hgPha"] + (["toa", "tot"] if acqMode == 1 else []):
+    values = np.ascontiguousarray(channels[name])
+    if inOrder:
+      events[name] = np.take(values, INVERSE_LUT, axis=1)
+    else:
+      events[name] = np.empty_like(values)
+      events[name][np.arange(records.size)[:, None], LUT[channelID]] = values
+  # TODO: Understand why there are values > 4096
+  np.minimum(events["lgPha"], 4096, out=events["lgPha"])
+  np.minimum(events["hgPha"], 4096, out=events["hgPha"])
+  return events
+
+
+def decodeFile(fname, acqMode=None, maxEvents=None, recover=False, skipped=None):
+  """Decode all the board events of a raw FERS file at once, as DRdecode does one at a time.
+     Returns a dict of arrays with one entry per event: BoardID, TriggerTimeStamp, TriggerID,
+     lgPha and hgPha (n, 64) in calorimeter mapping, and toa, tot (n, 64) with acqMode 1.
+     Events whose size does not match their channel mask are skipped.
+     acqMode (0 spectroscopy, 1 spectroscopy + timing) is read from the file header if not given.
+     With recover corrupted regions are skipped (see recordStarts) instead of stopping the decoding;
+     their (first byte, start of the next event) ranges are added to the skipped list, if given"""
+  raw = mapRaw(fname)
+  if acqMode is None:
+    acqMode = FILE_ACQ_MODE[int(raw[5])]
+  dtype = recordDtype(acqMode)
+  starts, ranges = recordStarts(raw, dtype.itemsize, recover=recover)
+  starts = starts[:maxEvents]
+  if skipped is not None:
+    skipped.extend(ranges)
+
+  # Events in sequence are a view of the file (no copy): one block per run of them
+  runs = np.split(starts, np.flatnonzero(np.diff(starts) != dtype.itemsize) + 1) if starts.size else []
+  blocks = [decodeRecords(raw[run[0] : run[-1] + dtype.itemsize].view(dtype), acqMode) for run in runs]
+  if len(blocks) == 0:
+    return decodeRecords(np.zeros(0, dtype), acqMode)
+  if len(blocks) == 1:
+    return blocks[0]
+  return {name: np.concatenate([block[name] for block in blocks]) for name in blocks[0]}
@@ -1,3 +1,4 @@
+import bz2
 import struct
 import numpy as np
 
@@ -26,6 +27,19 @@ NCHANNELS = 64
 EVENT_DATA_SIZE = [6, 11]
 EVENT_HEADER_SIZE = [27, 27]
 
+# Raw data archived by convert.py
+COMPRESSED_SUFFIXES = [".bz2", ".zst"]
+
+def openRaw(fname):
+  """Open a raw data file for binary reading, decompressing it on the fly
+     if archived (.bz2, or .zst). Compressed files can only be read forward"""
+  if fname.endswith(".bz2"):
+    return bz2.open(fname, "rb")
+  if fname.endswith(".zst"):
+    import zstandard # only needed for the zstd archives
+    return zstandard.ZstdDecompressor().stream_reader(open(fname, "rb"), read_across_frames=True)
+  return open(fname, "rb")
+
 class DRSiPMEvent:
   ''' Class that represent a Dual Readout event at TB 2021 @H8 '''
   
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 import DRSiPMEvent
+import DRSiPMDecoder
+import numpy as np
 import sys
 import ROOT
 import getopt
@@ -15,6 +17,8 @@ importlib.reload(DrBaseMon)
 PathToData='./'
 
 NBOARDS = 5
+# Bins of the channel histograms (0 - 4096) with underflow and overflow, as in TH1::SetContent
+NBINS = 4096 + 2
 
 ################################################################
 # SIGNAL HANDLER ###############################################
@@ -36,7 +40,7 @@ class DrSiPMMon(DrBaseMon.DrBaseMon):
     self.acqMode    = acqMode  # Acquisition mode of FERS boards
     self.maxEvts    = maxEvts  # Max number of events to process
     self.sample     = sample   # Sampling fraction
-    self.evtDict    = {}       # Dictionary of events
+    self.events     = None     # Arrays of the board events (see DRSiPMDecoder.decodeFile)
     self.hDict      = {}       # Dictionary of histograms
     #self.lastEv     = None     # Last DREvent object
     self.canvas     = None     # ROOT canvas
@@ -63,15 +67,6 @@ class DrSiPMMon(DrBaseMon.DrBaseMon):
     self.book1D( "boardID", self.hDict, NBOARDS, -0.5, 4.5, "BoardID", ymin=0)
     self.book1D( "numBoard", self.hDict, NBOARDS, 0.5, 5.5, "Num. of Boards per Event")
 
-##### DrMon method #######
-  def evtFill(self, evt):
-    '''Fill the event dictionary for combining board information into full event'''
-    key = str(evt.TriggerID)
-    if key in self.evtDict:
-      self.evtDict[key].append(evt)
-    else:
-      self.evtDict[key] = [evt]
-
 ##### DrMon method #######
   def checkEntryForOverUnderFlow(self, h, entry, trigID):
     '''Method for filling one entry into the histogram and checking for under-/overflow while filling'''
@@ -92,182 +87,87 @@ class DrSiPMMon(DrBaseMon.DrBaseMon):
     return goodentry
 
 ##### DrMon method #######
-  def hFill(self, event):
+  def hFill(self, events):
     '''Fill the histograms '''
     
     # These are the histograms which can be filled with "board info" only
     # i.e. no need to combine boards into full events
-    self.checkEntryForOverUnderFlow(self.hDict["boardID"], event.BoardID, event.TriggerID)
-    self.hDict["boardID"].Fill(event.BoardID)
-    self.hDict["triggerID"].Fill(event.TriggerID)
-    self.hDict["triggerTimeStamp"].Fill(event.TriggerTimeStamp)
+    bad = events["BoardID"] >= NBOARDS
+    for board, trigID in zip(events["BoardID"][bad], events["TriggerID"][bad]):
+      self.checkEntryForOverUnderFlow(self.hDict["boardID"], board, trigID)
+    n = events["BoardID"].size
+    weights = np.ones(n)
+    for name, key in [("boardID", "BoardID"), ("triggerID", "TriggerID"), ("triggerTimeStamp", "TriggerTimeStamp")]:
+      self.hDict[name].FillN(n, events[key].astype(np.float64), weights)
 
 ##### DrMon method #######
   def hFillEvent(self):
-    '''Fill the histograms with combined event information (after looping and combining event information) '''
-    
-    lg_values_for_channel = []
-    hg_values_for_channel = []
-    for i in range(DRSiPMEvent.NCHANNELS):
-      lg_values_for_channel.append([])
-      hg_values_for_channel.append([])
-
-    lg_channels_for_board = []
-    hg_channels_for_board = []
-
-    lg_board_dict = {}
-    hg_board_dict = {}
-    for i in range(NBOARDS):
-      lg_board_dict[f"{i}"] = {}
-      hg_board_dict[f"{i}"] = {}
-      for ch in range(DRSiPMEvent.NCHANNELS):
-        lg_board_dict[f"{i}"][f"{ch:02d}"] = []
-        hg_board_dict[f"{i}"][f"{ch:02d}"] = []
-
-    lglist = []
-    hglist = []
-
-    maxlg = 0
-    maxhg = 0
-
-    maxlg_list = [0]*DRSiPMEvent.NCHANNELS
-    maxhg_list = [0]*DRSiPMEvent.NCHANNELS
-
-    badevtcounter = 0
-
-    # one key is one triggerID
-    for key in list(self.evtDict.keys()):
-      
-      # for counting trigID independent of number of boards
-      uniqueTrigID = self.evtDict[key][0].TriggerID
-        
-      # Number of boards fired in this event
-      # if numboards exceeds 5 the entire event is skipped for all histograms
-      numboards = len(self.evtDict[key])
-      dofill = self.checkEntryForOverUnderFlow(self.hDict["numBoard"], numboards, uniqueTrigID)
-      if dofill: 
-        self.hDict["numBoard"].Fill(numboards)
-      else: 
-        badevtcounter += 1
-        del self.evtDict[key]
-        continue
-
-      self.hDict["uniqueTrigID"].Fill(uniqueTrigID)
-
-      lgPhaSum = 0
-      hgPhaSum = 0
-      # one "evt" is the information of one board 
-      for evt in self.evtDict[key]:
-        self.hFill(evt)
-        board = evt.BoardID
-        for channel_id, lg in enumerate(evt.lgPha):
-            lg_values_for_channel[channel_id].append(lg)
-            lg_board_dict[f"{board}"][f"{channel_id:02d}"].append(lg)
-            if lg > maxlg_list[channel_id]: maxlg_list[channel_id] = lg
-        for channel_id, hg in enumerate(evt.hgPha):
-            hg_values_for_channel[channel_id].append(hg)
-            hg_board_dict[f"{board}"][f"{channel_id:02d}"].append(hg)
-            if hg > maxhg_list[channel_id]: maxhg_list[channel_id] = hg
-            
-            
-        lgPhaSum += sum(evt.lgPha)
-        hgPhaSum += sum(evt.hgPha)
-        lglist.append(lgPhaSum)
-        hglist.append(hgPhaSum)
-        
-      if lgPhaSum > maxlg: maxlg = lgPhaSum 
-      if hgPhaSum > maxhg: maxhg = hgPhaSum
-
-    # can only book these histos after the maximal value is known
-    #self.book1D("lgPhaSum", self.hDict, 4096, 0, maxlg+1, "lgPha Sum")
-    #self.book1D("hgPhaSum", self.hDict, 8192, 0, maxhg+1, "hgPha Sum")
-    #self.book1D("lgPhaSumZoom", self.hDict, 512, 2000, 5000, "lg Pha Sum Zoom")
-    """
-    for i in range(DRSiPMEvent.NCHANNELS):
-        self.book1D(f"lgPha_{i:02d}", self.hDict, 4096, 0, maxlg_list[i]+1, f"lgPha for Channel {i:02d}")
-        self.book1D(f"hgPha_{i:02d}", self.hDict, 4096, 0, maxhg_list[i]+1, f"hgPha for Channel {i:02d}")
-    """
-    for board, board_dict in lg_board_dict.items():
-      for channel in board_dict.keys():
-        self.book1D(f"b{board}_ch{channel}_lg", self.hDict, 4096, 0, 4096, f"low gain ADC for board {board} channel {channel}")
-        self.book1D(f"b{board}_ch{channel}_hg", self.hDict, 4096, 0, 4096, f"high gain ADC for board {board} channel {channel}")
-    
-
-    # need to loop over the list again to fill histos
-    #for lg, hg in zip(lglist, hglist):
-    #  self.hDict["lgPhaSum"].Fill(lg)
-    #  self.hDict["hgPhaSum"].Fill(hg)
-    #  self.hDict["lgPhaSumZoom"].Fill(lg)
-
-    """
-    for i, channel in enumerate(lg_values_for_channel):
-      for value in channel:
-        key = f"lgPha_{i:02d}"
-        self.hDict[key].Fill(value)
-
-    for i, channel in enumerate(hg_values_for_channel):
-      for value in channel:
-        key = f"hgPha_{i:02d}"
-        self.hDict[key].Fill(value)
-    """
-    for board, board_dict in lg_board_dict.items():
-      for channel, channel_list in board_dict.items():
-        for value in channel_list:
-            self.hDict[f"b{board}_ch{channel}_lg"].Fill(value)
-
-    for board, board_dict in hg_board_dict.items():
-      for channel, channel_list in board_dict.items():
-        for value in channel_list:
-            self.hDict[f"b{board}_ch{channel}_hg"].Fill(value)
+    '''Fill the histograms with combined event information (after reading all the board events) '''
+
+    # one trigger is one event of (up to) 5 boards
+    triggers, trigger, numboards = np.unique(self.events["TriggerID"], return_inverse=True, return_counts=True)
+
+    # Number of boards fired in this event
+    # if numboards exceeds 5 the entire event is skipped for all histograms
+    good = numboards <= NBOARDS
+    for trigID, num in zip(triggers[~good], numboards[~good]):
+      self.checkEntryForOverUnderFlow(self.hDict["numBoard"], num, trigID)
+    badevtcounter = np.count_nonzero(~good)
+    n = np.count_nonzero(good)
+    self.hDict["numBoard"].FillN(n, numboards[good].astype(np.float64), np.ones(n))
+
+    # for counting trigID independent of number of boards
+    self.hDict["uniqueTrigID"].FillN(n, triggers[good].astype(np.float64), np.ones(n))
+
+    # board events of the good triggers
+    events = {key: values[good[trigger]] for key, values in self.events.items()}
+    self.hFill(events)
+
+    # ADC spectra of all channels: histogram bin of each value (clipped to 4096, the overflow bin)
+    # counted at once for all the channels of a board (one board at a time keeps the counts in cache)
+    offsets = np.arange(DRSiPMEvent.NCHANNELS) * NBINS + 1
+    counts = {gain: np.zeros((NBOARDS, DRSiPMEvent.NCHANNELS, NBINS)) for gain in ["lg", "hg"]}
+    for board in range(NBOARDS):
+      inBoard = events["BoardID"] == board
+      for gain, pha in [("lg", "lgPha"), ("hg", "hgPha")]:
+        values = (events[pha][inBoard] + offsets).ravel()
+        counts[gain][board] = np.bincount(values, minlength=DRSiPMEvent.NCHANNELS * NBINS).reshape(DRSiPMEvent.NCHANNELS, NBINS)
+
+    # Statistics (sum of w, w^2, w*x, w*x^2) that Fill would accumulate: values in range only, x the ADC value
+    adc = np.arange(NBINS - 2)
+    stats = {gain: np.stack([c[..., 1:-1].sum(axis=-1), c[..., 1:-1].sum(axis=-1), c[..., 1:-1] @ adc, c[..., 1:-1] @ adc**2], axis=-1)
+             for gain, c in counts.items()}
+
+    for board in range(NBOARDS):
+      for channel in range(DRSiPMEvent.NCHANNELS):
+        for gain, title in [("lg", "low gain"), ("hg", "high gain")]:
+          h = self.book1D(f"b{board}_ch{channel:02d}_{gain}", self.hDict, 4096, 0, 4096, f"{title} ADC for board {board} channel {channel:02d}")
+          h.SetContent(counts[gain][board, channel])
+          h.SetEntries(counts[gain][board, channel].sum())
+          h.PutStats(np.ascontiguousarray(stats[gain][board, channel]))
 
     print(f"Skipped {badevtcounter} events with more than 5 boards")
 
 
 ##### DrMon method #######
   def readFile(self, offset=0):
-    '''Read raw ascii data from file, call the decoding function, fill the histograms'''
-    print("Read and parse. Type CTRL+C to interrupt")
+    '''Read and decode the raw data from file (all board events at once), fill the histograms'''
+    print("Read and parse")
 
     if self.acqMode not in [0,1]: self.acqMode=0
-    
-    maxtrigid = 0
-    maxtrigtime = 0
-   
-    badboardcounter = 0
-    
-    with open(self.fname, "rb") as infile:
-      # reading in file header (not used atm)
-      data=infile.read(DRSiPMEvent.FILE_HEADER_SIZE)
-      i = 0
-      step = 1
-      while data:
-        data=infile.read(411)
-        if len(data)!=411: 
-            print("END OF FILE; "+str(len(data))+" bytes not read")
-            print(str(badboardcounter)+" entries with event size not matching")
-            continue
-        ev, offset = DRSiPMEvent.DRdecode(data, self.acqMode)
-        if offset:
-          infile.seek(-411, 1)
-          data=infile.read(411+offset)
-          badboardcounter += 1
-          continue
-        
-        # need to find max values for creating the histograms
-        if ev.TriggerID > maxtrigid: maxtrigid = ev.TriggerID
-        if ev.TriggerTimeStamp > maxtrigtime: maxtrigtime = ev.TriggerTimeStamp
-
-        # counter for number of entries read
-        i +=1
-        if i>step*10: step*=10
-        if i%step==0: print(i, "\t entries read")
-        
-        
-        # add ev to evtDict for combining into full event information (1 event consists out of (up to) 5 boards which are treated as one event in this loop) 
-        self.evtFill(ev)
 
-        if i>=self.maxEvts: break
-        
+    # corrupted regions of the file are skipped (and printed)
+    skipped = []
+    self.events = DRSiPMDecoder.decodeFile(self.fname, self.acqMode, self.maxEvts, recover=True, skipped=skipped)
+    for first, last in skipped:
+      print(BOLD, YELLOW, f"Corrupted data, skipped bytes {first} - {last}", NOCOLOR)
+    if skipped:
+      print(f"Recovered from {len(skipped)} corrupted regions, {sum(last - first for first, last in skipped)} bytes skipped")
+    print(self.events["TriggerID"].size, "\t entries read")
+
+    # need to find max values for creating the histograms
+    maxtrigid = int(self.events["TriggerID"].max(initial=0))
+    maxtrigtime = float(self.events["TriggerTimeStamp"].max(initial=0))
     
     self.book1D("triggerID", self.hDict, 50, 0, maxtrigid+1, "TriggerID", ymin=0)
     self.book1D("uniqueTrigID", self.hDict, 50, 0, maxtrigid+1, "UniqueTriggerID", ymin=0)
@@ -427,7 +327,7 @@ class DrSiPMMon(DrBaseMon.DrBaseMon):
 def Usage():
   print("Read raw data from text file and create monitor histograms")
   print("Usage: DrMon.py [options]")
-  print("   -f fname      Data file to analize (def=the latest data file)")
+  print("   -f fname      Data file to analize, also .bz2/.zst (def=the latest data file)")
   print("   -a acqMode    Data acquisition mode [0=spectroscopy, 1=spec+timing] (def=0)")
   print("   -e maxEv      Maximum numver of events to be monitored (def=inf)")  
   print("   -s sample     Analyze only one event every 'sample'")
@@ -470,6 +370,9 @@ if __name__ == "__main__":
   if run > 0:
     fname = f"Run{run}_list.dat"
     fname = PathToData + fname
+    # already archived by convert.py
+    for suffix in DRSiPMEvent.COMPRESSED_SUFFIXES:
+      if not os.path.isfile(fname) and os.path.isfile(fname + suffix): fname += suffix
   elif len(fname) < 1:
     list_of_files = glob.glob( PathToData + 'Run*_list.dat' ) 
     fname = max(list_of_files, key=os.path.getctime)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+##**************************************************
+## \file DWCTracks.py
+## \brief: vectorized straight-line track reconstruction
+##         from the two delay wire chambers (DWC)
+##**************************************************
+
+import argparse
+import numpy as np
+import uproot
+
+from PhysicsReader import loadCalibration, calibrateDWC, writeFriendTree
+
+# TDCsval index of each DWC channel (see PMT/README.md)
+DWCCHANNELS = ["DWC1L", "DWC1R", "DWC1U", "DWC1D", "DWC2L", "DWC2R", "DWC2U", "DWC2D"]
+# Pairs of channels of the same delay line: their time sum is constant for a good hit
+DWCLINES = [("DWC1L", "DWC1R"), ("DWC1U", "DWC1D"), ("DWC2L", "DWC2R"), ("DWC2U", "DWC2D")]
+
+
+def readTDCs(fname: str) -> dict:
+    """ Read the DWC TDC columns from a merged ntuple (CERNSPS2023 tree)
+        or from a physics ntuple in the "raw" layout (Ftree)
+
+    Args:
+        fname (str): input root file
+
+    Returns:
+        dict: (nEvents,) arrays keyed as DWCCHANNELS
+    """
+    with uproot.open(fname) as f:
+        if "CERNSPS2023" in f:
+            tdc = f["CERNSPS2023"]["TDCsval"].array(library="np")
+            return {c: tdc[:, i] for i, c in enumerate(DWCCHANNELS)}
+        return f["Ftree"].arrays(DWCCHANNELS, library="np")
+
+
+def reconstructTracks(tdcs: dict, cal: dict, zCalo: float = 0., lineSums: np.ndarray = None) -> dict:
+    """ Straight-line track through the two chambers for all events at once.
+
+        z coordinates are the ones of DWC_z in the calibration file.
+        The chamber-consistency chi2 compares the L+R and U+D time sums
+        of the four delay lines with their reference values (4 dof).
+
+    Args:
+        tdcs (dict): (nEvents,) TDC arrays keyed as DWCCHANNELS
+        cal (dict): constants from PhysicsReader.loadCalibration
+        zCalo (float): z of the calorimeter face
+        lineSums (np.ndarray): (4, 2) reference mean and sigma of each delay line sum.
+                               If None, they are estimated from the run (median and MAD)
+
+    Returns:
+        dict: XDWC1, YDWC1, XDWC2, YDWC2, slopeX, slopeY, XCalo, YCalo, chi2DWC and DWCGood columns
+
+    Raises:
+        ValueError: lineSums is None and no event has all the DWC channels
+    """
+    out = calibrateDWC(tdcs, cal)
+    z1, z2 = cal["DWC_z"]
+    x1 = out["XDWC1"].astype(np.float64)
+    y1 = out["YDWC1"].astype(np.float64)
+    slopeX = (out["XDWC2"] - x1) / (z2 - z1)
+    slopeY = (out["YDWC2"] - y1) / (z2 - z1)
+
+    sums = np.stack([tdcs[a].astype(np.float64) + tdcs[b] for a, b in DWCLINES])
+    good = np.all(np.stack([tdcs[c] >= 0 for c in DWCCHANNELS]), axis=0)
+    if lineSums is None:
+        if not good.any():
+            raise ValueError("No event with all DWC channels: pass lineSums to compute the track chi2")
+        ref = np.median(sums[:, good], axis=1)
+        sigma = 1.4826 * np.median(np.abs(sums[:, good] - ref[:, None]), axis=1)
+        lineSums = np.stack([ref, np.maximum(sigma, 1.)], axis=1)
+    chi2 = np.sum(((sums - lineSums[:, 0, None]) / lineSums[:, 1, None]) ** 2, axis=0)
+
+    out["slopeX"] = slopeX.astype(np.float32)
+    out["slopeY"] = slopeY.astype(np.float32)
+    out["XCalo"] = (x1 + slopeX * (zCalo - z1)).astype(np.float32)
+    out["YCalo"] = (y1 + slopeY * (zCalo - z1)).astype(np.float32)
+    out["chi2DWC"] = chi2.astype(np.float32)
+    out["DWCGood"] = good
+    return out
+
+
+def beamSpotMask(tracks: dict, x0: float, y0: float, radius: float, chi2Max: float = np.inf) -> np.ndarray:
+    """ Select events whose track hits the calorimeter within radius of (x0, y0)
+
+    Args:
+        tracks (dict): output of reconstructTracks
+        x0 (float): beam spot x at the calorimeter face
+        y0 (float): beam spot y at the calorimeter face
+        radius (float): selection radius
+        chi2Max (float): maximum chamber-consistency chi2
+
+    Returns:
+        np.ndarray: boolean mask
+    """
+    r2 = (tracks["XCalo"] - x0) ** 2 + (tracks["YCalo"] - y0) ** 2
+    return tracks["DWCGood"] & (r2 < radius ** 2) & (tracks["chi2DWC"] < chi2Max)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DWCTracks - reconstruct DWC tracks of a run and store them in a DWCTracks friend tree')
+    parser.add_argument('-i','--input', dest='input', required=True,
+                        help='merged ntuple or physics ntuple in the "raw" layout')
+    parser.add_argument('-o','--output', dest='output', required=True,
+                        help='root file where the DWCTracks tree is added (e.g. the physics ntuple)')
+    parser.add_argument('-c','--calibra_file', dest='calibrationfile', required=True,
+                        help='calibration file')
+    parser.add_argument('-z','--zcalo', dest='zcalo', type=float, default=0.,
+                        help='z of the calorimeter face, in the DWC_z frame')
+    par = parser.parse_args()
+
+    tracks = reconstructTracks(readTDCs(par.input), loadCalibration(par.calibrationfile), par.zcalo)
+    writeFriendTree(par.output, "DWCTracks", tracks)
+
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,28 @@ def returnRunNumber(x: str) -> str:
     return m.group(1)
 
 
+def addDerivedColumns(mergedFile: str, physicsFile: str, calFile: str):
+    """ Batch stages run on the whole physics ntuple: DWC tracks and SiPM shower shapes.
+        Each one is stored as a friend tree of Ftree in the physics ntuple.
+
+    Args:
+        mergedFile (str): merged ntuple the physics ntuple was made from
+        physicsFile (str): physics ntuple ("flat" or "raw" layout)
+        calFile (str): calibration file
+    """
+    from PhysicsReader import PhysicsReader, loadCalibration, writeFriendTree
+    from DWCTracks import readTDCs, reconstructTracks
+    from SiPMShowerShape import showerShapeColumns
+
+    tracks = reconstructTracks(readTDCs(mergedFile), loadCalibration(calFile))
+    writeFriendTree(physicsFile, "DWCTracks", tracks)
+
+    reader = PhysicsReader(physicsFile, calFile)
+    columns = showerShapeColumns(reader["SiPMPheS"], reader["SiPMPheC"])
+    reader.file.close()
+    writeFriendTree(physicsFile, "SiPMShowerShape", columns)
+
+
 def main():
     """IT MAY NOT BE A GOOD IDEA SINCE THE OUTPUT NAME IS DEFINED IN PhysicsConverter.C script.
 
@@ -42,7 +64,17 @@ def main():
     parser.add_argument('-c','--calibra_file', action='store', dest='calibrationfile',
                         default='/afs/cern.ch/user/i/ideadr/devel/TBDataPreparation/2023_SPS/scripts/RunXXX_modified.json',
                         help='calibration file')
+    parser.add_argument('-l','--layout', action='store', dest='layout',
+                        default='object', choices=['object', 'flat', 'raw'],
+                        help='output layout: "object" (EventOut in the Events branch), "flat" (one branch per EventOut member, readable with uproot without the class dictionary) or "raw" (uncalibrated flat branches, calibrated at read time with PhysicsReader.py)')
+    parser.add_argument('--derived', action='store_true', dest='derived',
+                        default=False,
+                        help='add the DWCTracks and SiPMShowerShape friend trees to the output (needs the "flat" or "raw" layout)')
     par = parser.parse_args()
+
+    if par.derived and par.layout == 'object':
+        print( 'ERROR! --derived needs the "flat" or "raw" layout.' )
+        return -1
     
     if not os.path.isdir(par.datapath):
         print( 'ERROR! Input directory ' + par.datapath + ' does not exist.' )
@@ -74,10 +106,12 @@ def main():
     macroPath = os.getenv('IDEARepo') + "/2023_SPS/scripts/"
     print(macroPath)
     for fl in mrgfls:
-        cmnd1 = "root -l -b -q -x '"+macroPath+"PhysicsConverter.C(\""+fl+"\", \""+par.datapath+"\", \""+calFile+"\" )'"
+        cmnd1 = "root -l -b -q -x '"+macroPath+"PhysicsConverter.C(\""+fl+"\", \""+par.datapath+"\", \""+calFile+"\", \""+par.layout+"\" )'"
         os.system(cmnd1)
         cmnd2 = "mv physics_sps2023_run"+fl+".root "+phspath  ### Really careful here!
         os.system(cmnd2)
+        if par.derived:
+            addDerivedColumns(par.datapath+"merged_sps2023_run"+fl+".root", phspath+"physics_sps2023_run"+fl+".root", calFile)
 
     if not mrgfls:
         print( "No new files found.")
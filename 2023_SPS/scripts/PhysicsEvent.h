@@ -72,6 +72,26 @@ DWCCalibration::DWCCalibration(const std::string& fname){
     DWC_z = jFile["Calibrations"]["DWC"]["DWC_z"];
 }
 
+// Fibre coordinates of the 160 S and 160 C SiPMs, computed once
+// index = row*16 + column, see EventOut::SiPMRow and EventOut::SiPMCol
+struct SiPMGeometry{
+    std::array<double,160> xS, yS, xC, yC;
+    SiPMGeometry();
+};
+
+SiPMGeometry::SiPMGeometry(){
+    for(int index=0;index<160;++index){
+        int row = index / 16;
+        int column = index%16;
+        xS[index] = (column-7)*2-1.5;
+        yS[index] = 2.*sq3*(4-row)+sq3/2;
+        xC[index] = (column-7)*2-0.5;
+        yC[index] = 2.*sq3*(4-row)+1.5*sq3;
+    }
+}
+
+const SiPMGeometry sipmGeometry;
+
 /**
  * 
  */
@@ -100,18 +120,10 @@ class EventOut{
         int SiPMRow(int index){ return index/16; }
         
         pair<double, double> SiPMSpos(int index){
-            int row = index / 16;
-            int column = index%16;
-            double x = (column-7)*2-1.5;
-            double y = 2.*sq3*(4-row)+sq3/2;
-            return pair<double,double>(x,y);
+            return pair<double,double>(sipmGeometry.xS[index],sipmGeometry.yS[index]);
         }
         pair<double, double> SiPMCpos(int index){
-            int row = index / 16;
-            int column = index%16;
-            double x = (column-7)*2-0.5;
-            double y = 2.*sq3*(4-row)+1.5*sq3;
-            return pair<double,double>(x,y);
+            return pair<double,double>(sipmGeometry.xC[index],sipmGeometry.yC[index]);
         }
 };
 
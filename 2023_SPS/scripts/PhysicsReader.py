@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+##**************************************************
+## \file PhysicsReader.py
+## \brief: read-time calibration of physics ntuples
+##         written by PhysicsConverter.C in the "raw"
+##         (or "flat") layout
+##**************************************************
+
+import json
+import os
+import numpy as np
+import uproot
+
+# Use HG below this number of photoelectrons, LG above (see Event::calibrate)
+HGLGSWITCH = 140.
+
+PMTCOLUMNS = [f"SPMT{i}" for i in range(1, 9)] + [f"CPMT{i}" for i in range(1, 9)]
+DWCCOLUMNS = ["XDWC1", "XDWC2", "YDWC1", "YDWC2"]
+SIPMCOLUMNS = ["SiPMPheC", "SiPMPheS", "totSiPMCene", "totSiPMSene", "NSiPMZero"]
+# Columns copied unchanged from the raw layout
+PASSCOLUMNS = ["EventID", "PShower", "MCounter", "C1", "C2", "C3"]
+
+
+def loadCalibration(calFile: str) -> dict:
+    """ Read the calibration constants from the json file used by PhysicsConverter.C
+
+    Args:
+        calFile (str): calibration file (same format as RunXXX_modified.json)
+
+    Returns:
+        dict: numpy arrays of the constants, keyed as in the json file
+    """
+    with open(calFile) as f:
+        cal = json.load(f)["Calibrations"]
+    constants = {}
+    for group in ["SiPM", "PMT", "DWC"]:
+        for key, value in cal[group].items():
+            constants[key] = np.asarray(value, dtype=np.float64)
+    return constants
+
+
+def calibrateSiPM(hg: np.ndarray, lg: np.ndarray, cal: dict) -> dict:
+    """ Vectorized version of Event::calibrate
+
+    Args:
+        hg (np.ndarray): (nEvents, 320) high gain ADCs
+        lg (np.ndarray): (nEvents, 320) low gain ADCs
+        cal (dict): constants from loadCalibration
+
+    Returns:
+        dict: SiPMPheC, SiPMPheS, totSiPMCene, totSiPMSene and NSiPMZero columns
+    """
+    nEvents = hg.shape[0]
+    highGainPe = (hg - cal["highGainPedestal"]) / cal["highGainDpp"]
+    lowGainPe = (lg - cal["lowGainPedestal"]) / cal["lowGainDpp"]
+    phe = highGainPe * (highGainPe < HGLGSWITCH) + lowGainPe * (highGainPe > HGLGSWITCH)
+    # Boards not triggered are left at 0
+    phe[hg <= 0] = 0
+
+    # Channel i is in row i/16: even rows are Cherenkov, odd rows are scintillation
+    phe = phe.reshape(nEvents, 10, 2, 16)
+    pheC = (phe[:, :, 0, :].reshape(nEvents, 160) / cal["PhetoGeVC"][0]).astype(np.float32)
+    pheS = (phe[:, :, 1, :].reshape(nEvents, 160) / cal["PhetoGeVS"][0]).astype(np.float32)
+    return {
+        "SiPMPheC": pheC,
+        "SiPMPheS": pheS,
+        "totSiPMCene": pheC.sum(axis=1, dtype=np.float64).astype(np.float32),
+        "totSiPMSene": pheS.sum(axis=1, dtype=np.float64).astype(np.float32),
+        "NSiPMZero": np.count_nonzero(hg <= 0, axis=1).astype(np.int32),
+    }
+
+
+def calibratePMT(adcs: dict, cal: dict) -> dict:
+    """ Vectorized version of Event::calibratePMT
+
+    Args:
+        adcs (dict): raw SPMT1-8 and CPMT1-8 columns
+        cal (dict): constants from loadCalibration
+
+    Returns:
+        dict: calibrated SPMT1-8, CPMT1-8, SPMTenergy and CPMTenergy columns
+    """
+    out = {}
+    for i in range(8):
+        out[f"SPMT{i+1}"] = ((adcs[f"SPMT{i+1}"] - cal["PMTS_pd"][i]) / cal["PMTS_pk"][i]).astype(np.float32)
+        out[f"CPMT{i+1}"] = ((adcs[f"CPMT{i+1}"] - cal["PMTC_pd"][i]) / cal["PMTC_pk"][i]).astype(np.float32)
+    out["SPMTenergy"] = np.sum([out[f"SPMT{i}"] for i in range(1, 9)], axis=0, dtype=np.float32)
+    out["CPMTenergy"] = np.sum([out[f"CPMT{i}"] for i in range(1, 9)], axis=0, dtype=np.float32)
+    return out
+
+
+def calibrateDWC(tdcs: dict, cal: dict) -> dict:
+    """ Vectorized version of Event::calibrateDWC
+
+    Args:
+        tdcs (dict): raw DWC1L, DWC1R, ..., DWC2D columns
+        cal (dict): constants from loadCalibration
+
+    Returns:
+        dict: XDWC1, YDWC1, XDWC2 and YDWC2 columns
+    """
+    sl, offs, tons = cal["DWC_sl"], cal["DWC_offs"], cal["DWC_tons"][0]
+    return {
+        "XDWC1": ((tdcs["DWC1R"] - tdcs["DWC1L"]) * sl[0] * tons + offs[0]).astype(np.float32),
+        "YDWC1": ((tdcs["DWC1D"] - tdcs["DWC1U"]) * sl[1] * tons + offs[1]).astype(np.float32),
+        "XDWC2": ((tdcs["DWC2R"] - tdcs["DWC2L"]) * sl[2] * tons + offs[2]).astype(np.float32),
+        "YDWC2": ((tdcs["DWC2D"] - tdcs["DWC2U"]) * sl[3] * tons + offs[3]).astype(np.float32),
+    }
+
+
+def writeFriendTree(fname: str, treeName: str, columns: dict):
+    """ Add a tree with per-event columns to a root file (created if missing).
+        With the same number of entries as Ftree, it can be used as its friend.
+
+    Args:
+        fname (str): root file
+        treeName (str): name of the new tree
+        columns (dict): (nEvents, ...) numpy arrays keyed by branch name
+    """
+    openFile = uproot.update if os.path.isfile(fname) else uproot.recreate
+    with openFile(fname) as f:
+        f[treeName] = columns
+
+
+class PhysicsReader:
+    """ Column reader of a physics ntuple that calibrates on access.
+
+    Raw branches are read only when a column needs them and are kept in
+    memory, so changing the calibration with setCalibration only costs
+    the array arithmetic. Files in the "flat" layout are read as they are.
+
+    Example:
+        reader = PhysicsReader("physics_sps2023_run100.root", "RunXXX_modified.json")
+        energy = reader["totSiPMSene"]
+        reader.setCalibration("RunXXX_new.json")
+        energy = reader["totSiPMSene"]
+    """
+
+    def __init__(self, fname: str, calFile: str = None, treeName: str = "Ftree", entry_start=None, entry_stop=None):
+        self.file = uproot.open(fname)
+        self.tree = self.file[treeName]
+        self.entry_start = entry_start
+        self.entry_stop = entry_stop
+        self.raw = "SiPMHighGain" in self.tree.keys()
+        self.rawCache = {}
+        self.calCache = {}
+        self.cal = None
+        if calFile is not None:
+            self.setCalibration(calFile)
+
+    def setCalibration(self, calFile: str):
+        """ Use the constants of calFile for all the columns read from now on """
+        self.cal = loadCalibration(calFile)
+        self.calCache = {}
+
+    def readBranch(self, name: str) -> np.ndarray:
+        if name not in self.rawCache:
+            self.rawCache[name] = self.tree[name].array(
+                library="np", entry_start=self.entry_start, entry_stop=self.entry_stop
+            )
+        return self.rawCache[name]
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if not self.raw or name in PASSCOLUMNS:
+            return self.readBranch(name)
+        if name not in self.calCache:
+            if self.cal is None:
+                raise RuntimeError("A calibration file is needed to read calibrated columns")
+            if name in SIPMCOLUMNS:
+                self.calCache.update(
+                    calibrateSiPM(self.readBranch("SiPMHighGain"), self.readBranch("SiPMLowGain"), self.cal)
+                )
+            elif name in PMTCOLUMNS or name in ["SPMTenergy", "CPMTenergy"]:
+                self.calCache.update(calibratePMT({c: self.readBranch(c) for c in PMTCOLUMNS}, self.cal))
+            elif name in DWCCOLUMNS:
+                tdcs = {c: self.readBranch(c) for c in ["DWC1L", "DWC1R", "DWC1U", "DWC1D", "DWC2L", "DWC2R", "DWC2U", "DWC2D"]}
+                self.calCache.update(calibrateDWC(tdcs, self.cal))
+            else:
+                # Raw columns (e.g. SiPMHighGain, DWC1L) are returned as stored
+                return self.readBranch(name)
+        return self.calCache[name]
+
+    def arrays(self, names: list) -> dict:
+        """ Read several columns
+
+        Args:
+            names (list): column names (EventOut data members or raw branches)
+
+        Returns:
+            dict: numpy arrays keyed by column name
+        """
+        return {name: self[name] for name in names}
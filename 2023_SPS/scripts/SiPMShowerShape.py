@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+##**************************************************
+## \file SiPMShowerShape.py
+## \brief: SiPM fibre coordinate tables and batched
+##         shower-shape observables (barycentre,
+##         lateral second moments, core/halo ratio)
+##**************************************************
+
+import argparse
+import numpy as np
+
+from PhysicsReader import PhysicsReader, writeFriendTree
+
+# Fibre coordinates of the 160 S and 160 C SiPMs (same as EventOut::SiPMSpos/SiPMCpos)
+_row, _column = np.divmod(np.arange(160), 16)
+SIPMSX = (_column - 7) * 2 - 1.5
+SIPMSY = 2. * np.sqrt(3.) * (4 - _row) + np.sqrt(3.) / 2
+SIPMCX = (_column - 7) * 2 - 0.5
+SIPMCY = 2. * np.sqrt(3.) * (4 - _row) + 1.5 * np.sqrt(3.)
+
+# Radius around the barycentre defining the shower core
+RCORE = 4.
+# Events processed at once (bounds the memory of the distance matrices)
+CHUNKSIZE = 100000
+
+
+def showerShape(energy: np.ndarray, x: np.ndarray, y: np.ndarray, rCore: float = RCORE) -> dict:
+    """ Shower shape of all events with matrix operations.
+        Negative cell energies (pedestal fluctuations) are not used as weights.
+
+    Args:
+        energy (np.ndarray): (nEvents, 160) cell energies (SiPMPheS or SiPMPheC)
+        x (np.ndarray): (160,) cell x coordinates
+        y (np.ndarray): (160,) cell y coordinates
+        rCore (float): core radius around the barycentre
+
+    Returns:
+        dict: (nEvents,) arrays XBary, YBary, XSigma, YSigma and CoreHalo
+    """
+    out = {key: np.empty(energy.shape[0], dtype=np.float32) for key in ["XBary", "YBary", "XSigma", "YSigma", "CoreHalo"]}
+    for start in range(0, energy.shape[0], CHUNKSIZE):
+        chunk = slice(start, start + CHUNKSIZE)
+        w = np.clip(energy[chunk], 0, None).astype(np.float64)
+        tot = w.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            xb = (w @ x) / tot
+            yb = (w @ y) / tot
+            sxx = (w @ x ** 2) / tot - xb ** 2
+            syy = (w @ y ** 2) / tot - yb ** 2
+            d2 = (x - xb[:, None]) ** 2 + (y - yb[:, None]) ** 2
+            core = np.sum(w * (d2 < rCore ** 2), axis=1)
+            out["CoreHalo"][chunk] = core / (tot - core)
+        out["XBary"][chunk] = xb
+        out["YBary"][chunk] = yb
+        out["XSigma"][chunk] = np.sqrt(np.clip(sxx, 0, None))
+        out["YSigma"][chunk] = np.sqrt(np.clip(syy, 0, None))
+    return out
+
+
+def showerShapeColumns(pheS: np.ndarray, pheC: np.ndarray, rCore: float = RCORE) -> dict:
+    """ Shower shape columns of the S and C SiPMs
+
+    Args:
+        pheS (np.ndarray): (nEvents, 160) SiPMPheS
+        pheC (np.ndarray): (nEvents, 160) SiPMPheC
+        rCore (float): core radius around the barycentre
+
+    Returns:
+        dict: XBaryS, YBaryS, ..., CoreHaloC columns
+    """
+    columns = {}
+    for suffix, energy, x, y in [("S", pheS, SIPMSX, SIPMSY), ("C", pheC, SIPMCX, SIPMCY)]:
+        for key, value in showerShape(energy, x, y, rCore).items():
+            columns[key + suffix] = value
+    return columns
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SiPMShowerShape - compute SiPM shower shapes of a physics ntuple and store them in a SiPMShowerShape friend tree')
+    parser.add_argument('-i','--input', dest='input', required=True,
+                        help='physics ntuple in the "flat" or "raw" layout')
+    parser.add_argument('-c','--calibra_file', dest='calibrationfile', default=None,
+                        help='calibration file (needed for the "raw" layout)')
+    parser.add_argument('-r','--rcore', dest='rcore', type=float, default=RCORE,
+                        help='core radius around the barycentre')
+    par = parser.parse_args()
+
+    reader = PhysicsReader(par.input, par.calibrationfile)
+    columns = showerShapeColumns(reader["SiPMPheS"], reader["SiPMPheC"], par.rcore)
+    reader.file.close()
+    writeFriendTree(par.input, "SiPMShowerShape", columns)
+
+
+if __name__ == "__main__":
+    main()